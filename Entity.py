@@ -1,6 +1,203 @@
+import numpy as np
+
+
 class Tweet:
-    def __init__(self, id=None, text=None, tw_type=None, label=None):
+    __slots__ = ('id', 'text', 'tw_type', 'label', 'duplicates')
+
+    def __init__(self, id=None, text=None, tw_type=None, label=None, duplicates=None):
         self.id = id
         self.text = text
         self.tw_type = tw_type
         self.label = label
+        # Ids of the near duplicates removed in favour of this tweet
+        self.duplicates = duplicates
+
+
+class TextStore:
+    """
+    Compact, immutable list of strings: one UTF-8 buffer and the offset of each string.
+    Slicing is zero-copy, other indexing gathers the selected strings.
+    """
+
+    def __init__(self, offsets, buffer):
+        self.offsets = offsets
+        self.buffer = buffer
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.buffer.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                # Offsets are absolute, the buffer is shared
+                return TextStore(self.offsets[start:max(start, stop) + 1], self.buffer)
+            key = np.arange(start, stop, step)
+
+        if np.ndim(key) == 0:
+            key = int(key)
+            if key < 0:
+                key += len(self)
+            return self.buffer[self.offsets[key]:self.offsets[key + 1]].tobytes().decode("utf-8")
+
+        return self.take(key)
+
+    def take(self, indices):
+        """New store with the strings at indices (or where a boolean mask is True)"""
+
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+
+        # Negative indices count from the end, as in the other columns
+        indices = np.where(indices < 0, indices + len(self), indices).astype(np.int64)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError("index out of range for {} strings".format(len(self)))
+
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # Position in self.buffer of every byte of the new buffer
+        segments = np.repeat(np.arange(len(indices)), lengths)
+        positions = starts[segments] + np.arange(offsets[-1]) - offsets[segments]
+
+        return TextStore(offsets, self.buffer[positions])
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        offsets = self.offsets.tolist()
+        buffer = self.buffer[offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+
+        return [buffer[offsets[i] - base:offsets[i + 1] - base].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+class TweetBatch:
+    """
+    Columnar list of tweets: numpy arrays of ids, types and labels and a TextStore of texts.
+
+    Iterating or indexing with an int gives Tweet objects (copies), so it can be
+    used where a list of tweets is read. Slices are zero-copy views, boolean
+    masks and index arrays select tweets, and labels can be assigned at once:
+
+        batch = batch[0:6300]
+        batch.labels = kmedoids.labels_
+
+    duplicates is None or a list with the ids of the near duplicates of each tweet.
+    """
+
+    def __init__(self, ids, texts, types=None, labels=None, duplicates=None):
+        n = len(texts)
+
+        self.ids = np.asarray(ids)
+        self.texts = texts
+        self.types = types
+        self.labels = labels
+        self.duplicates = duplicates
+
+        if len(self.ids) != n:
+            raise ValueError("ids and texts must have the same length")
+
+    @classmethod
+    def from_tweets(cls, tweets):
+        tweets = list(tweets)
+
+        duplicates = [tw.duplicates for tw in tweets]
+        if all(duplicate is None for duplicate in duplicates):
+            duplicates = None
+
+        return cls([tw.id for tw in tweets], [tw.text for tw in tweets],
+                   [tw.tw_type for tw in tweets], [tw.label for tw in tweets], duplicates)
+
+    def to_tweets(self):
+        return list(self)
+
+    @property
+    def texts(self):
+        return self._texts
+
+    @texts.setter
+    def texts(self, texts):
+        self._texts = texts if isinstance(texts, TextStore) else TextStore.from_strings(texts)
+
+    @property
+    def types(self):
+        return self._types
+
+    @types.setter
+    def types(self, types):
+        self._types = self._column(types)
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = self._column(labels)
+
+    def _column(self, values):
+        if values is None:
+            return np.full(len(self._texts), None, dtype=object)
+
+        values = np.asarray(values)
+        if len(values) != len(self._texts):
+            raise ValueError("Columns must have one value per tweet")
+
+        return values
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __getitem__(self, key):
+        if np.ndim(key) == 0 and not isinstance(key, slice):
+            return Tweet(_item(self.ids[key]), self._texts[key], _item(self.types[key]), _item(self.labels[key]),
+                         None if self.duplicates is None else self.duplicates[key])
+
+        if not isinstance(key, slice):
+            key = np.asarray(key)
+            if key.dtype == bool:
+                key = np.flatnonzero(key)
+
+        if self.duplicates is None:
+            duplicates = None
+        elif isinstance(key, slice):
+            duplicates = self.duplicates[key]
+        else:
+            duplicates = [self.duplicates[i] for i in key]
+
+        return TweetBatch(self.ids[key], self._texts[key], self.types[key], self.labels[key], duplicates)
+
+    def __iter__(self):
+        texts = self._texts.tolist()
+        ids = self.ids.tolist()
+        types = self.types.tolist()
+        labels = self.labels.tolist()
+
+        for i in range(len(texts)):
+            yield Tweet(ids[i], texts[i], types[i], labels[i],
+                        None if self.duplicates is None else self.duplicates[i])
+
+
+def _item(value):
+    """numpy scalars as python values"""
+
+    return value.item() if isinstance(value, np.generic) else value
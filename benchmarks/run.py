@@ -0,0 +1,263 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from queue import Empty
+
+from sklearn.feature_extraction.text import HashingVectorizer
+
+import filter
+import util
+import metrics.jaccard_minhash as jaccard_minhash
+from benchmarks import synthetic
+from cluster.eac import EAC
+from cluster.kmedoids import KMedoids
+
+#
+# usage: python -m benchmarks.run [-h] [-s SIZES ...] [--stages STAGES ...] [-o OUTPUT]
+#                                 [-b BASELINE] [--save-baseline] [-t TOLERANCE]
+
+SIZES = [1000, 5000, 20000, 50000]
+
+# Results are compared with this file, written by --save-baseline
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Relative increase of time or peak memory reported as a regression
+TOLERANCE = 0.25
+
+# Seed of the synthetic tweets, the same for every run
+SEED = 0
+
+
+def _texts(tweets):
+    return [tw.text for tw in tweets]
+
+
+def _cleaned_texts(tweets):
+    return filter.clean_batch(_texts(tweets))
+
+
+def _distance(tweets):
+    return jaccard_minhash.jaccard_minhash_distance_mp(_cleaned_texts(tweets), condensed=True)
+
+
+def _features(tweets):
+    return HashingVectorizer(norm='l2').fit_transform(_cleaned_texts(tweets))
+
+
+def _csv_file(tweets):
+    path = os.path.join(tempfile.mkdtemp(), "tweets.csv")
+    util.save_to_file(tweets, path)
+
+    return path
+
+
+# name: (setup, run, throughput unit, estimated bytes for n tweets)
+# setup(tweets) builds the input of run out of the timer, once per repetition
+STAGES = {
+    'clean': (_texts, lambda texts: [filter.clean(text) for text in texts], "tweets", lambda n: 0),
+    'filter_tweets': (copy.deepcopy, lambda tweets: filter.filter_tweets(tweets, art=True, frequency=True),
+                      "tweets", lambda n: 0),
+    'read_from_file': (_csv_file, util.read_from_file, "tweets", lambda n: 0),
+    'save_to_file': (lambda tweets: (tweets, os.path.join(tempfile.mkdtemp(), "tweets.csv")),
+                     lambda args: util.save_to_file(*args), "tweets", lambda n: 0),
+    'generate_minhash_list': (_cleaned_texts, jaccard_minhash._generate_minhash_list, "tweets", lambda n: 0),
+    'minhash_signatures': (_cleaned_texts, jaccard_minhash.minhash_signatures, "tweets", lambda n: 0),
+    'minhash_signatures_mp': (_cleaned_texts, lambda texts: jaccard_minhash.minhash_signatures(texts, n_jobs=-1),
+                              "tweets", lambda n: 0),
+    'jaccard_minhash_distance': (_cleaned_texts,
+                                 lambda texts: jaccard_minhash.jaccard_minhash_distance(texts, condensed=True),
+                                 "pairs", lambda n: n * n // 2),
+    'jaccard_minhash_distance_mp': (_cleaned_texts,
+                                    lambda texts: jaccard_minhash.jaccard_minhash_distance_mp(texts,
+                                                                                              condensed=True),
+                                    "pairs", lambda n: n * n // 2),
+    'eac_fit': (_features, lambda X: EAC(10, min_k=2, max_k=10).fit(X), "tweets",
+                # condensed co-association counts, one byte per pair
+                lambda n: n * n // 2),
+    'kmedoids_fit': (_distance,
+                     lambda D: KMedoids(2, init='random', distance_metric='precomputed', random_state=SEED).fit(D),
+                     "tweets", lambda n: n * n // 2),
+}
+
+
+def _items(unit, n):
+    return n * (n - 1) // 2 if unit == "pairs" else n
+
+
+def _peak_rss(who):
+    """Peak resident memory in MB of this process or of its largest child"""
+
+    peak = resource.getrusage(who).ru_maxrss
+
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def _measure(stage, n, repeat, queue):
+    """Times a stage in a fresh process, so that its peak memory is its own"""
+
+    setup, run, unit, _ = STAGES[stage]
+
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as workdir:
+        # Files written by the stages are removed with workdir
+        tempfile.tempdir = workdir
+
+        tweets = synthetic.generate_tweets(n, seed=SEED)
+
+        seconds = []
+        for _ in range(repeat):
+            args = setup(tweets)
+            t0 = time.perf_counter()
+            run(args)
+            seconds.append(time.perf_counter() - t0)
+
+    best = min(seconds)
+    queue.put({'stage': stage, 'n': n, 'seconds': best,
+               'throughput': _items(unit, n) / best if best > 0 else None, 'unit': unit,
+               'peak_rss_mb': _peak_rss(resource.RUSAGE_SELF),
+               'peak_children_rss_mb': _peak_rss(resource.RUSAGE_CHILDREN)})
+
+
+def run_benchmarks(sizes=SIZES, stages=None, repeat=1, max_memory=None):
+    """
+    Runs every stage for every size, each one in its own process.
+
+    Stages that would need more than max_memory bytes (half of the physical
+    memory by default) are skipped.
+
+    :return results: list of dicts, one per stage and size
+    """
+
+    if max_memory is None:
+        max_memory = _physical_memory() // 2
+
+    ctx = multiprocessing.get_context("spawn")
+
+    results = []
+    for stage in stages or list(STAGES):
+        for n in sizes:
+            if STAGES[stage][3](n) > max_memory:
+                result = {'stage': stage, 'n': n, 'skipped': "needs more than {} MB".format(max_memory >> 20)}
+            else:
+                queue = ctx.Queue()
+                process = ctx.Process(target=_measure, args=(stage, n, repeat, queue))
+                process.start()
+                result = _wait_result(process, queue, stage, n)
+                process.join()
+
+            results.append(result)
+            _print_result(result)
+
+    return results
+
+
+def _wait_result(process, queue, stage, n):
+    """Result of the measuring process, or why it was lost if it died (e.g. out of memory)"""
+
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive() and queue.empty():
+                return {'stage': stage, 'n': n, 'skipped': "failed, exit code {}".format(process.exitcode)}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Returns the results slower or with a higher peak memory (of the stage's
+    process or of its children) than their baseline by more than tolerance,
+    as (result, baseline result, measure) tuples.
+    """
+
+    base = {(result['stage'], result['n']): result for result in baseline['results'] if 'skipped' not in result}
+
+    regressions = []
+    for result in results:
+        previous = base.get((result['stage'], result['n']))
+        if previous is None or 'skipped' in result:
+            continue
+
+        # The children are the pools of the multiprocess stages
+        for measure in ('seconds', 'peak_rss_mb', 'peak_children_rss_mb'):
+            if measure in previous and result[measure] > previous[measure] * (1 + tolerance):
+                regressions.append((result, previous, measure))
+
+    return regressions
+
+
+def _physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 << 30
+
+
+def _machine():
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': multiprocessing.cpu_count()}
+
+
+def _print_result(result):
+    if 'skipped' in result:
+        print("{:<30}{:>8}  skipped, {}".format(result['stage'], result['n'], result['skipped']))
+    else:
+        print("{:<30}{:>8}{:>12.3f}s{:>14.0f} {}/s{:>10.1f} MB".format(
+            result['stage'], result['n'], result['seconds'], result['throughput'] or 0, result['unit'],
+            max(result['peak_rss_mb'], result['peak_children_rss_mb'])))
+
+
+def main(sizes, stages, repeat, max_memory, outputfilepath, baselinefilepath, save_baseline, tolerance):
+
+    report = {'machine': _machine(), 'seed': SEED,
+              'results': run_benchmarks(sizes, stages, repeat, max_memory)}
+
+    if outputfilepath:
+        with open(outputfilepath, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+
+    if save_baseline:
+        with open(baselinefilepath, "w") as baselineFile:
+            json.dump(report, baselineFile, indent=2)
+        print("Baseline saved:", baselinefilepath)
+        return 0
+
+    if not os.path.exists(baselinefilepath):
+        print("No baseline to compare with:", baselinefilepath)
+        return 0
+
+    with open(baselinefilepath) as baselineFile:
+        regressions = compare(report['results'], json.load(baselineFile), tolerance)
+
+    for result, previous, measure in regressions:
+        print("Regression: {} n={} {} {:.3f} -> {:.3f}".format(result['stage'], result['n'], measure,
+                                                                 previous[measure], result[measure]))
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+
+    # Read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=SIZES, help="Numbers of tweets")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), help="Stages to run, all by default")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Runs of each stage, the best is kept")
+    parser.add_argument("-m", "--max-memory", type=int, help="Skip the stages that need more MB")
+    parser.add_argument("-o", "--output", help="Output JSON path")
+    parser.add_argument("-b", "--baseline", default=BASELINE, help="Baseline JSON path")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("-t", "--tolerance", type=float, default=TOLERANCE,
+                        help="Relative increase reported as a regression")
+    args = parser.parse_args()
+
+    sys.exit(main(args.sizes, args.stages, args.repeat, args.max_memory and args.max_memory << 20,
+                  args.output, args.baseline, args.save_baseline, args.tolerance))
@@ -0,0 +1,134 @@
+import numpy as np
+
+import Entity
+import filter
+
+# Syllables of the generated words, roughly Spanish
+_ONSETS = ['', 'b', 'c', 'ch', 'd', 'f', 'g', 'j', 'l', 'll', 'm', 'n', 'ñ', 'p', 'qu', 'r', 'rr', 's', 't',
+           'v', 'z', 'br', 'cl', 'tr', 'pl']
+_VOWELS = ['a', 'e', 'i', 'o', 'u', 'á', 'é', 'í', 'ó', 'ú']
+_CODAS = ['', '', '', 'n', 's', 'r', 'l']
+
+# Share of the words of a tweet that are articles, pronouns and prepositions
+STOP_WORD_RATE = 0.3
+
+# Probability of a mention, a url, an emoji and a RT in a tweet
+MENTION_RATE = 0.3
+URL_RATE = 0.2
+EMOJI_RATE = 0.1
+RT_RATE = 0.15
+
+
+def generate_vocabulary(size, seed=0):
+    """Returns size distinct pseudo Spanish words"""
+
+    rng = np.random.RandomState(seed)
+
+    words = []
+    seen = set()
+    while len(words) < size:
+        n_syllables = rng.randint(1, 5)
+        word = "".join(_ONSETS[rng.randint(len(_ONSETS))] + _VOWELS[rng.randint(len(_VOWELS))] +
+                       _CODAS[rng.randint(len(_CODAS))] for _ in range(n_syllables))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+
+    return words
+
+
+def generate_tweets(n, n_clusters=2, vocabulary_size=5000, duplicate_rate=0.1, separation=0.5,
+                    words_per_tweet=(5, 20), seed=0):
+    """
+    Deterministic synthetic Spanish tweets, with the raw noise filter.clean removes
+    (mentions, urls, emoji, RT, punctuation, upper case).
+
+    Every cluster has its own topic, a random Zipf distribution over the
+    vocabulary. Each word of a tweet comes from the topic of its cluster with
+    probability separation and from the background (the same Zipf for every
+    cluster) otherwise. The cluster of each tweet is its tw_type, "cluster<i>".
+
+    :param n: int, required
+        Number of tweets
+
+    :param n_clusters: int, optional, default: 2
+
+    :param vocabulary_size: int, optional, default: 5000
+        Number of distinct content words
+
+    :param duplicate_rate: float, optional, default: 0.1
+        Probability of a tweet being a copy (retweet or same text) of a previous one
+
+    :param separation: float, optional, default: 0.5
+        0 for clusters with the same words, 1 for clusters with their own words only
+
+    :param words_per_tweet: (int, int), optional, default: (5, 20)
+
+    :param seed: int, optional, default: 0
+
+    :return tweets: list of Entity.Tweet
+    """
+
+    rng = np.random.RandomState(seed)
+    vocabulary = np.array(generate_vocabulary(vocabulary_size, seed))
+    stop_words = np.array(sorted(filter._ART_PRO_PRE))
+
+    ranks = np.arange(1, vocabulary_size + 1)
+    zipf = 1 / ranks
+    zipf /= zipf.sum()
+
+    # Word of each Zipf rank, for the background and each topic
+    background = rng.permutation(vocabulary_size)
+    topics = [rng.permutation(vocabulary_size) for _ in range(n_clusters)]
+
+    clusters = rng.randint(n_clusters, size=n)
+    lengths = rng.randint(words_per_tweet[0], words_per_tweet[1] + 1, size=n)
+
+    # Words of every tweet, drawn at once
+    total = int(lengths.sum())
+    word_ranks = rng.choice(vocabulary_size, size=total, p=zipf)
+    from_topic = rng.random_sample(total) < separation
+    is_stop_word = rng.random_sample(total) < STOP_WORD_RATE
+    stop_word_ics = rng.randint(len(stop_words), size=total)
+    word_clusters = np.repeat(clusters, lengths)
+
+    word_ics = background[word_ranks]
+    for cluster in range(n_clusters):
+        in_topic = from_topic & (word_clusters == cluster)
+        word_ics[in_topic] = topics[cluster][word_ranks[in_topic]]
+
+    words = np.where(is_stop_word, stop_words[stop_word_ics], vocabulary[word_ics]).tolist()
+
+    duplicates = rng.random_sample(n) < duplicate_rate
+    sources = (rng.random_sample(n) * np.arange(n)).astype(np.int64)
+    noise = rng.random_sample((n, 4))
+    capitalized = rng.random_sample(n) < 0.5
+
+    tweets = []
+    start = 0
+    for i in range(n):
+        stop = start + lengths[i]
+
+        if duplicates[i] and i > 0:
+            source = tweets[sources[i]]
+            prefix = "RT @usuario{}: ".format(sources[i] % 997) if noise[i, 3] < 0.5 else ""
+            tweets.append(Entity.Tweet(str(i), prefix + source.text, source.tw_type))
+            start = stop
+            continue
+
+        text = " ".join(words[start:stop])
+        if capitalized[i]:
+            text = text[:1].upper() + text[1:]
+        if noise[i, 0] < MENTION_RATE:
+            text = "@usuario{} {}".format(i % 997, text)
+        if noise[i, 1] < URL_RATE:
+            text += " https://t.co/{:x}".format(i)
+        if noise[i, 2] < EMOJI_RATE:
+            text += " \U0001F600"
+        if noise[i, 3] < RT_RATE:
+            text = "RT " + text
+
+        tweets.append(Entity.Tweet(str(i), text + "!", "cluster{}".format(clusters[i])))
+        start = stop
+
+    return tweets
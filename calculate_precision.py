@@ -1,26 +1,239 @@
+import argparse
 import json
+import os
+import warnings
 
-with open('results/cosine-minhash-eac/N6300_100_eac_kmeans.json', 'r') as infile:
-    confusion_matrix_s = json.load(infile)
+import numpy as np
+from scipy import stats
 
-confusion_matrix_s = confusion_matrix_s[0:50]
+#
+# usage: calculate_precision.py [-h] [-r RUNS] [-s CLASS_SIZES ...] [-c CONFIDENCE] [-o OUTPUT]
+#                               results [results ...]
+#
+# e.g. python calculate_precision.py results/cosine-minhash-eac/N6300_100_eac_kmeans.json -r 50
+#
+# The class sizes are read from the .classes.json file export_results saves next to
+# each result, -s overrides them for every file.
 
-average_confusion_matrix = [[0,0],[0,0]]
+# Confidence level of the intervals
+CONFIDENCE = 0.95
 
-for conf_mat in confusion_matrix_s:
-    for i in range(2):
-        for j in range(2):
-            average_confusion_matrix[i][j] += conf_mat[i][j]
+# Suffix of the class sizes files of export_results, e.g. N6300_100_eac_kmeans.classes.json
+CLASSES_SUFFIX = ".classes.json"
 
-for k in range(2):
-    for l in range(2):
-        average_confusion_matrix[k][l] /= 50
 
-for m in range(2):
-    for n in range(2):
-        print(average_confusion_matrix[m][n], end='  ')
-    print('\n')
+def load_results(paths, runs=None):
+    """
+    Loads the precision matrices saved by export_results into one array.
 
-print((average_confusion_matrix[0][0]*2409 + average_confusion_matrix[1][1]*3901)/6300)
+    Files with fewer runs are padded with NaN, which the statistics ignore.
+    Directories are searched for .json and .trials.jsonl files; the accepted
+    results of the .trials.jsonl checkpoints are read as well.
 
+    :param paths: list of string, files or directories
+    :param runs: int, optional, default: None
+        Use only the first runs of each file
+    :return names, results: list of file paths, float array, shape=(files, runs, k, k)
+    """
 
+    names = _expand(paths)
+    matrices = [np.asarray(_read(name)[:runs], dtype=np.float64) for name in names]
+
+    ks = {matrix.shape[1:] for matrix in matrices if matrix.size}
+    if len(ks) > 1:
+        raise ValueError("All the results must have the same number of types, got {}".format(sorted(ks)))
+    k = ks.pop()[0] if ks else 0
+
+    results = np.full((len(names), max([len(matrix) for matrix in matrices] or [0]), k, k), np.nan)
+    for i, matrix in enumerate(matrices):
+        results[i, :len(matrix)] = matrix
+
+    return names, results
+
+
+def summarize(results, class_sizes=None, confidence=CONFIDENCE):
+    """
+    Statistics of each file of results, all at once.
+
+    The weighted accuracy of a run is the fraction of the tweets in the cluster
+    assigned to their type, i.e. the diagonal weighted by the class sizes.
+
+    :param results: float array, shape=(files, runs, k, k), from load_results
+    :param class_sizes: array, shape=(k,) or (files, k), optional, default: None
+        Rows of NaN, or None, weight every type the same, with a warning
+    :param confidence: float, optional, default: CONFIDENCE
+    :return summary: dict of arrays
+        runs (files,), class_sizes (files, k), NaN if unknown, mean, std and ci (files, k, k),
+        accuracy (files, runs),
+        accuracy_mean, accuracy_std and accuracy_ci (files,).
+        ci are the half widths of the Student t confidence intervals of the means
+    """
+
+    files, k = results.shape[0], results.shape[-1]
+    if class_sizes is None:
+        class_sizes = np.full(k, np.nan)
+
+    class_sizes = np.asarray(class_sizes, dtype=np.float64)
+    if class_sizes.shape[-1] != k:
+        raise ValueError("class_sizes must have {} values".format(k))
+    weights = np.array(np.broadcast_to(class_sizes, (files, k)))
+
+    unknown = np.isnan(weights).any(axis=1)
+    if unknown.any():
+        warnings.warn("No class sizes for {} of {} result files, their accuracy is the unweighted mean of "
+                      "the diagonal".format(int(unknown.sum()), files))
+        weights[unknown] = 1
+
+    runs = np.sum(~np.isnan(results[:, :, 0, 0]), axis=1)
+    accuracy = np.einsum('frk,fk->fr', np.diagonal(results, axis1=2, axis2=3),
+                         weights / weights.sum(axis=1)[:, None])
+
+    summary = {'runs': runs, 'class_sizes': np.where(unknown[:, None], np.nan, weights)}
+    for name, values in (('', results), ('accuracy_', accuracy)):
+        mean, std, ci = _mean_std_ci(values, runs, confidence)
+        summary[name + 'mean'], summary[name + 'std'], summary[name + 'ci'] = mean, std, ci
+    summary['accuracy'] = accuracy
+
+    return summary
+
+
+def _mean_std_ci(values, runs, confidence):
+    """Mean, sample std and confidence interval half width over axis 1"""
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nanmean(values, axis=1)
+        std = np.sqrt(np.nansum((values - np.expand_dims(mean, 1)) ** 2, axis=1) /
+                      np.reshape(runs - 1, runs.shape + (1,) * (mean.ndim - 1)))
+
+        margin = stats.t.ppf((1 + confidence) / 2, np.maximum(runs - 1, 1)) / np.sqrt(runs)
+        ci = std * np.reshape(margin, runs.shape + (1,) * (mean.ndim - 1))
+
+    return mean, std, ci
+
+
+def load_class_sizes(names, k):
+    """
+    Class sizes saved by export_results next to each result file.
+
+    :param names: list of result file paths, from load_results
+    :param k: int, number of types
+    :return class_sizes: float array, shape=(files, k), rows of NaN where there is no file
+    """
+
+    class_sizes = np.full((len(names), k), np.nan)
+    for i, name in enumerate(names):
+        path = _classes_path(name)
+        if not os.path.exists(path):
+            continue
+
+        with open(path, encoding="utf8") as classesFile:
+            sizes = json.load(classesFile)['sizes']
+        if len(sizes) != k:
+            raise ValueError("{} has {} class sizes, the results have {} types".format(path, len(sizes), k))
+        class_sizes[i] = sizes
+
+    return class_sizes
+
+
+def _classes_path(name):
+    for suffix in (".trials.jsonl", ".json"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)] + CLASSES_SUFFIX
+
+    return name + CLASSES_SUFFIX
+
+
+def _expand(paths):
+    """
+    Result files of paths. In directories, only the outputs of export_results are
+    taken: .json lists of precision matrices, and the .trials.jsonl checkpoints
+    whose .json wasn't saved (the same runs would be read twice otherwise).
+    """
+
+    names = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    if name.endswith(".trials.jsonl"):
+                        if name[:-len(".trials.jsonl")] + ".json" not in files:
+                            names.append(os.path.join(root, name))
+                    elif name.endswith(".json") and not name.endswith(CLASSES_SUFFIX) and \
+                            _is_result(os.path.join(root, name)):
+                        names.append(os.path.join(root, name))
+        else:
+            names.append(path)
+
+    return names
+
+
+def _is_result(name):
+    """True if the JSON file name is a list of square precision matrices"""
+
+    try:
+        with open(name, encoding="utf8") as inputFile:
+            matrices = json.load(inputFile)
+    except ValueError:
+        return False
+
+    return isinstance(matrices, list) and all(
+        isinstance(matrix, list) and all(isinstance(row, list) and len(row) == len(matrix) for row in matrix)
+        for matrix in matrices)
+
+
+def _read(name):
+    with open(name, encoding="utf8") as inputFile:
+        if not name.endswith(".jsonl"):
+            return json.load(inputFile)
+
+        records = []
+        for line in inputFile:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    records = {record['trial']: record for record in records}
+
+    return [records[trial]['result'] for trial in sorted(records) if records[trial]['accepted']]
+
+
+def main(paths, runs=None, class_sizes=None, confidence=CONFIDENCE, outputfilepath=None):
+
+    names, results = load_results(paths, runs)
+    if class_sizes is None:
+        class_sizes = load_class_sizes(names, results.shape[-1])
+    summary = summarize(results, class_sizes, confidence)
+
+    for i, name in enumerate(names):
+        print(name, "({} runs, class sizes {})".format(summary['runs'][i], summary['class_sizes'][i].tolist()))
+        for row in summary['mean'][i]:
+            for value in row:
+                print(value, end='  ')
+            print('\n')
+        print("Accuracy: {:.4f} +- {:.4f} (std {:.4f})\n".format(summary['accuracy_mean'][i],
+                                                                  summary['accuracy_ci'][i],
+                                                                  summary['accuracy_std'][i]))
+
+    if outputfilepath:
+        with open(outputfilepath, "w") as outputFile:
+            json.dump({'confidence': confidence, 'files': names,
+                       **{key: value.tolist() for key, value in summary.items() if key != 'accuracy'}},
+                      outputFile)
+
+    return names, summary
+
+
+if __name__ == "__main__":
+
+    # Read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("results", nargs="+", help="Result files or directories of export_results")
+    parser.add_argument("-r", "--runs", type=int, help="Use only the first runs of each file")
+    parser.add_argument("-s", "--class-sizes", type=int, nargs="+",
+                        help="Number of tweets of each type, instead of the .classes.json files")
+    parser.add_argument("-c", "--confidence", type=float, default=CONFIDENCE, help="Confidence level")
+    parser.add_argument("-o", "--output", help="Output JSON path")
+    args = parser.parse_args()
+
+    main(args.results, args.runs, args.class_sizes, args.confidence, args.output)
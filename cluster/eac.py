@@ -3,8 +3,19 @@ from functools import partial
 
 from sklearn.cluster import KMeans
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
 import copy
 
+from cluster.shared import SharedInput
+from metrics.condensed import CondensedDistance
+import instrumentation
+
+# Number of rows of the co-association matrix updated at once
+CHUNK_SIZE = 256
+
 
 class EAC:
     """
@@ -24,9 +35,29 @@ class EAC:
     min_k : int, optional, default: 10
         Max number of K clusters
 
+    n_jobs : int, optional, default: None
+        Number of worker processes of the pool created by fit when no pool is given.
+        None means cpu_count() - 1 and -1 all the processors. With a single job
+        the iterations run in the calling process.
+
+    pool : multiprocessing.Pool or concurrent.futures.Executor, optional, default: None
+        External pool reused across fits. EAC never closes it.
+
+    Attributes
+    ----------
+    co_asoc_matrix : array, shape=(n_samples * (n_samples - 1) / 2,)
+        Number of iterations each pair of samples was clustered together,
+        condensed upper triangle in the smallest unsigned type that holds them.
+
+    distance_ : CondensedDistance
+        The co-association counts decoded as (iterations - count) / iterations.
+
     """
 
-    def __init__(self, iterations=8, clustering=None, min_k=5, max_k=10):
+    # Supported linkages of extract_partition
+    LINKAGES = ['single', 'average']
+
+    def __init__(self, iterations=8, clustering=None, min_k=5, max_k=10, n_jobs=None, pool=None):
 
         self.iterations = iterations
 
@@ -36,8 +67,14 @@ class EAC:
 
         self.max_k = max_k
 
+        self.n_jobs = n_jobs
+
+        self.pool = pool
+
         self.co_asoc_matrix = None
 
+        self.distance_ = None
+
     def _check_init_args(self):
 
         if self.clustering:
@@ -47,6 +84,19 @@ class EAC:
             km = KMeans(init='k-means++', n_init=1, max_iter=100)
             self.clustering = km
 
+        if self.n_jobs is not None and (self.n_jobs == 0 or self.n_jobs < -1):
+            raise ValueError("n_jobs has to be a positive integer, -1 or None")
+
+    def _get_n_jobs(self):
+
+        if self.n_jobs is None:
+            return max(multiprocessing.cpu_count() - 1, 1)
+        if self.n_jobs == -1:
+            return multiprocessing.cpu_count()
+
+        return self.n_jobs
+
+    @instrumentation.timed("eac.fit")
     def fit(self, X):
         """
         Fit EAC of selected clustering to the provided data.
@@ -54,6 +104,8 @@ class EAC:
         Parameters
         ----------
         X : array-like matrix, shape=(n_samples, n_features)
+            or precomputed distance matrix (dense or CondensedDistance) if the
+            clustering method is KMedoids(distance_metric='precomputed')
 
         Returns
         -------
@@ -62,49 +114,232 @@ class EAC:
 
         self._check_init_args()
 
-        # Setup Multiprocessing
-        pool = multiprocessing.Pool(multiprocessing.cpu_count()-1)
-        func = partial(self.EAC_worker, X)
+        # Choose random k values between min_k and max_k
+        ks = np.random.randint(self.min_k, self.max_k, self.iterations)
 
-        results = pool.imap_unordered(func, range(self.iterations))
-
-        # Generate EAC distance matrix
+        # Count how many times each pair of samples is clustered together, condensed upper triangle
         m, n = X.shape
-        self.distance_ = np.zeros((m, m))
-
-        for partial_dist in results:
-            self.distance_ += partial_dist
+        self.co_asoc_matrix = np.zeros(m * (m - 1) // 2, dtype=self._co_asoc_dtype())
 
-        pool.close()
-        pool.join()
+        pool = self.pool
+        if pool is None and self._get_n_jobs() > 1:
+            pool = multiprocessing.Pool(self._get_n_jobs())
 
-        self.distance_ /= self.iterations
+        if pool is None:
+            for k in ks:
+                self._update_co_asoc_matrix(_eac_worker(self.clustering, X, k))
+        else:
+            try:
+                # X is published once, tasks only carry its shared memory handle
+                with SharedInput(X) as shared_X:
+                    instrumentation.count("bytes_shared", shared_X.nbytes)
+                    func = partial(_eac_worker, self.clustering, shared_X)
+
+                    if hasattr(pool, 'imap_unordered'):
+                        results = pool.imap_unordered(func, ks)
+                    else:
+                        results = pool.map(func, ks)
+
+                    for labels in results:
+                        instrumentation.count("bytes_received", labels.nbytes)
+                        self._update_co_asoc_matrix(labels)
+            finally:
+                if pool is not self.pool:
+                    pool.close()
+                    pool.join()
+
+        instrumentation.count("iterations", self.iterations)
+
+        # EAC distance matrix, the counts decoded as (iterations - count) / iterations on demand
+        self.distance_ = CondensedDistance(self.co_asoc_matrix, m, num_perm=self.iterations)
 
         return self
 
-    def EAC_worker(self, X, i):
+    def extract_partition(self, n_clusters=None, linkage='single'):
+        """
+        Consensus partition of the fitted EAC: hierarchical clustering of distance_.
 
-        # Choose random k value between min_k and max_k
-        k = np.random.randint(self.min_k, self.max_k)
+        'single' builds a minimum spanning tree of distance_ with Prim's algorithm,
+        one row at a time (O(n^2) time, O(n) extra memory, distance_ can be a
+        CondensedDistance), and cuts its n_clusters - 1 longest edges. Single
+        linkage tends to chain everything into one cluster on noisy co-association
+        matrices, 'average' is usually more robust but needs the n(n-1)/2
+        distances as float64 (scipy.cluster.hierarchy).
 
-        # Run clustering
-        clustering = copy.deepcopy(self.clustering)
+        If n_clusters is None, the tree is cut at the largest gap between
+        consecutive merge distances, where the clusters have the longest
+        lifetime, or not at all (one cluster) if every merge is at the same distance.
 
-        # If it's a K cluster algorithm
-        if hasattr(self.clustering, 'n_clusters'):
-            clustering.n_clusters = k
+        Parameters
+        ----------
+        n_clusters : int, optional, default: None
 
-        clustering.fit(X)
+        linkage : {'single', 'average'}, optional, default: 'single'
 
-        # Update co-association matrix
-        m, n = X.shape
-        partial_dist = np.ones((m, m))
+        Returns
+        -------
+        labels : int array, shape=(n_samples,)
+            Also saved in labels_, clusters are numbered by first appearance
+        """
+
+        if self.distance_ is None:
+            raise ValueError("EAC has to be fitted before extracting a partition")
+
+        if linkage not in self.LINKAGES:
+            raise ValueError("linkage must be one of {}".format(self.LINKAGES))
+
+        n = self.distance_.shape[0]
+        if n_clusters is not None and not 1 <= n_clusters <= n:
+            raise ValueError("n_clusters has to be between 1 and the number of samples")
+
+        if linkage == 'single':
+            edges, weights = _minimum_spanning_tree(self.distance_)
+            heights = np.sort(weights, kind='stable')
+        elif n > 1:
+            Z = hierarchy.linkage(_condensed_values(self.distance_), method='average')
+            heights = Z[:, 2]
+        else:
+            heights = np.empty(0)
+
+        if n_clusters is None:
+            n_clusters = _largest_gap_clusters(heights)
+
+        if linkage == 'single':
+            # Edges joining the clusters, from the shortest
+            kept = edges[np.argsort(weights, kind='stable')[:n - n_clusters]]
+            graph = sparse.csr_matrix((np.ones(len(kept)), (kept[:, 0], kept[:, 1])), shape=(n, n))
+            _, components = csgraph.connected_components(graph, directed=False)
+        else:
+            components = hierarchy.cut_tree(Z, n_clusters=n_clusters)[:, 0] if n > 1 else np.zeros(n)
+
+        # Number the clusters by first appearance
+        _, first, inverse = np.unique(components, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(first))
+
+        self.labels_ = rank[inverse.ravel()]
+
+        return self.labels_
+
+    def _co_asoc_dtype(self):
+        """Smallest unsigned type that holds counts up to the number of iterations"""
+
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if self.iterations <= np.iinfo(dtype).max:
+                return dtype
+
+        return np.uint64
+
+    def _update_co_asoc_matrix(self, labels):
+        """Add one to the pairs of samples that share a cluster in labels"""
+
+        # Negative labels are noise, they don't share a cluster with anything
+        clustered = labels >= 0
+
+        m = len(labels)
+        columns = np.arange(m)
+        for start in range(0, m, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, m)
+            same = labels[start:stop, None] == labels[None, :]
+            same &= clustered[start:stop, None]
+
+            # The upper triangle of rows [start, stop) is contiguous in the condensed counts
+            upper = columns[None, :] > columns[start:stop, None]
+            first = start * m - start * (start + 1) // 2
+            last = stop * m - stop * (stop + 1) // 2
+            self.co_asoc_matrix[first:last] += same[upper]
+
+
+def _largest_gap_clusters(heights):
+    """
+    Number of clusters left by cutting a hierarchy at the largest gap between
+    consecutive merge distances, 1 if there is no gap.
+
+    :param heights: float array, shape=(n - 1,), sorted merge distances
+    """
+
+    n = len(heights) + 1
+    if n <= 2:
+        return 1
+
+    gaps = np.diff(heights)
+    largest = int(np.argmax(gaps))
+    if gaps[largest] <= 0:
+        return 1
+
+    # The merges up to the largest gap are kept
+    return n - largest - 1
+
+
+def _condensed_values(D):
+    """Float64 condensed upper triangle of D, dense or CondensedDistance, as scipy expects"""
+
+    if isinstance(D, np.ndarray):
+        return squareform(D, checks=False).astype(np.float64)
+
+    if D.triangle == 'upper':
+        return D._decode(D.values)
+
+    return np.concatenate([D.row(i)[i + 1:] for i in range(D.n)])
+
+
+def _minimum_spanning_tree(D):
+    """
+    Prim's minimum spanning tree of the complete graph of distances D.
+
+    :param D: distance matrix, or any object with shape and take(indices, axis=0)
+    :return edges, weights: int array, shape=(n - 1, 2), float array, shape=(n - 1,)
+    """
+
+    n = D.shape[0]
+
+    in_tree = np.zeros(n, dtype=bool)
+
+    # Distance from each vertex out of the tree to the tree, and its closest tree vertex
+    best = np.full(n, np.inf)
+    parent = np.zeros(n, dtype=np.int64)
+
+    edges = np.empty((max(n - 1, 0), 2), dtype=np.int64)
+    weights = np.empty(max(n - 1, 0))
+
+    vertex = 0
+    for step in range(n - 1):
+        in_tree[vertex] = True
+
+        row = np.asarray(D.take([vertex], axis=0)[0], dtype=np.float64)
+        closer = ~in_tree & (row < best)
+        best[closer] = row[closer]
+        parent[closer] = vertex
+
+        # Ties are broken by the lowest index, so the tree is deterministic
+        vertex = int(np.argmin(np.where(in_tree, np.inf, best)))
+        edges[step] = parent[vertex], vertex
+        weights[step] = best[vertex]
+
+    return edges, weights
+
+
+def _eac_worker(clustering, X, k):
+    """
+    Runs one clustering with k clusters and returns its labels.
+
+    :param clustering: clustering object, copied before fitting
+    :param X: input matrix or its SharedInput
+    :param k: int
+    :return labels: array, shape=(n_samples,)
+    """
+
+    if isinstance(X, SharedInput):
+        X = X.get()
+
+    # Run clustering
+    clustering = copy.deepcopy(clustering)
+
+    # If it's a K cluster algorithm
+    if hasattr(clustering, 'n_clusters'):
+        clustering.n_clusters = int(k)
 
-        # For each cluster
-        for j in range(k):
-            cluster = np.where(clustering.labels_ == j)[0]
-            for row in cluster:
-                for column in cluster:
-                    partial_dist[row, column] = 0
+    clustering.fit(X)
 
-        return partial_dist
+    # Only the labels are sent back, the co-association matrix is updated by fit
+    return np.asarray(clustering.labels_)
@@ -14,6 +14,8 @@ from sklearn.metrics.pairwise import PAIRWISE_DISTANCE_FUNCTIONS
 from sklearn.utils import check_array, check_random_state
 from sklearn.utils.validation import check_is_fitted
 
+import instrumentation
+
 class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
     """
     k-medoids class.
@@ -26,28 +28,62 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
     distance_metric : string, optional, default: 'euclidean'
         What distance metric to use.
 
-    clustering : {'pam'}, optional, default: 'pam'
-        What clustering mode to use.
+    clustering : {'pam', 'fastpam', 'clara', 'clarans'}, optional, default: 'pam'
+        What clustering mode to use. 'pam' alternates assignment and
+        medoid update (Voronoi iteration). 'fastpam' runs the FastPAM2 swap
+        phase, evaluating every (medoid, candidate) swap in one pass over D.
+        'clara' runs FastPAM on random samples and 'clarans' a randomized
+        swap search. Both only compute distances to the candidate medoids,
+        so they never build the n x n matrix and can't be 'precomputed'.
 
-    init : {'random', 'heuristic'}, optional, default: 'heuristic'
-        Specify medoid initialization.
+    init : {'random', 'heuristic', 'build', 'k-medoids++'}, optional, default: 'heuristic'
+        Specify medoid initialization. 'build' is the greedy PAM BUILD,
+        'k-medoids++' samples medoids proportionally to the distance to the
+        nearest medoid already chosen.
 
     max_iter : int, optional, default : 300
         Specify the maximum number of iterations when fitting.
 
     random_state : int, optional, default: None
         Specify random state for the random number generator.
+
+    n_sampling : int, optional, default: None
+        Size of the CLARA samples. None means 40 + 2 * n_clusters.
+
+    n_sampling_iter : int, optional, default: 5
+        Number of CLARA samples.
+
+    num_local : int, optional, default: 2
+        Number of CLARANS restarts.
+
+    max_neighbor : int, optional, default: None
+        Number of consecutive non improving swaps that stop a CLARANS
+        search. None means max(250, 1.25% of n_clusters * (n_samples - n_clusters)).
+
+    A callable distance_metric is called as distance_metric(X) and
+    distance_metric(X, Y), like the sklearn pairwise distances.
+
+    With distance_metric='precomputed', fit accepts a dense distance matrix or
+    any object exposing shape, take(indices, axis=0) and sum(axis=1), such as
+    metrics.condensed.CondensedDistance.
     """
 
+    # Number of cluster members whose distances are decoded at once
+    CHUNK_SIZE = 256
+
     # Supported clustering methods
-    CLUSTERING_METHODS = ['pam']
+    CLUSTERING_METHODS = ['pam', 'fastpam', 'clara', 'clarans']
+
+    # Clustering methods that compute distances on demand
+    SAMPLING_METHODS = ['clara', 'clarans']
 
     # Supported initialization methods
-    INIT_METHODS = ['random', 'heuristic']
+    INIT_METHODS = ['random', 'heuristic', 'build', 'k-medoids++']
 
     def __init__(self, n_clusters=8, distance_metric='euclidean',
                  clustering_method='pam', init='heuristic',
-                 max_iter=300, random_state=None):
+                 max_iter=300, random_state=None, n_sampling=None,
+                 n_sampling_iter=5, num_local=2, max_neighbor=None):
 
         self.n_clusters = n_clusters
 
@@ -61,6 +97,14 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
 
         self.random_state = random_state
 
+        self.n_sampling = n_sampling
+
+        self.n_sampling_iter = n_sampling_iter
+
+        self.num_local = num_local
+
+        self.max_neighbor = max_neighbor
+
     def _check_init_args(self):
 
         # Check n_clusters
@@ -87,6 +131,12 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
             raise ValueError("clustering must be one of the following: " +
                              "{}".format(self.CLUSTERING_METHODS))
 
+        if self.clustering_method in self.SAMPLING_METHODS and \
+                self.distance_metric == 'precomputed':
+            raise ValueError("clustering '{}' ".format(self.clustering_method) +
+                             "computes its own distances, distance_metric " +
+                             "can't be 'precomputed'")
+
         # Check init
         if self.init not in self.INIT_METHODS:
             raise ValueError("init needs to be one of " +
@@ -96,13 +146,14 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
         # Check random state
         self.random_state_ = check_random_state(self.random_state)
 
+    @instrumentation.timed("kmedoids.fit")
     def fit(self, X):
         """Fit K-Medoids to the provided data.
 
         Parameters
         ----------
         X : array-like or sparse matrix, shape=(n_samples, n_features)
-        D : distance matrix
+        D : distance matrix or CondensedDistance
 
         Returns
         -------
@@ -111,6 +162,22 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
 
         self._check_init_args()
 
+        instrumentation.count("tweets", X.shape[0] if hasattr(X, 'shape') else len(X))
+
+        if self.clustering_method in self.SAMPLING_METHODS:
+            X = self._check_array(X)
+
+            if self.clustering_method == 'clara':
+                medoid_ics, cluster_ics = self._clara(X)
+            else:
+                medoid_ics, cluster_ics = self._clarans(X)
+
+            self.labels_ = cluster_ics
+            self.medoid_indices_ = np.asarray(medoid_ics)
+            self.cluster_centers_ = X.take(medoid_ics, axis=0)
+
+            return self
+
         if self.distance_metric == 'precomputed':
             D = X
         else:
@@ -123,6 +190,27 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
 
         medoid_ics = self._get_initial_medoid_indices(D, self.n_clusters)
 
+        if self.clustering_method == 'fastpam':
+            medoid_ics, cluster_ics = self._fastpam(D, medoid_ics)
+        else:
+            medoid_ics, cluster_ics = self._pam(D, medoid_ics)
+
+        # Expose labels_ which are the assignments of
+        # the training data to clusters
+        self.labels_ = cluster_ics
+
+        # Expose the index of each medoid, label i is medoid_indices_[i]
+        self.medoid_indices_ = np.asarray(medoid_ics)
+
+        # Expose cluster centers, i.e. medoids
+        self.cluster_centers_ = X.take(medoid_ics, axis=0)
+
+        # Return self to enable method chaining
+        return self
+
+    def _pam(self, D, medoid_ics):
+        """Voronoi iteration, returns the medoid and cluster indices"""
+
         # Old medoids will be stored here for reference
         old_medoid_ics = np.zeros((self.n_clusters,))
 
@@ -144,15 +232,216 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
             # Update medoids with the new cluster indices
             self._update_medoid_ics_in_place(D, cluster_ics, medoid_ics)
 
-        # Expose labels_ which are the assignments of
-        # the training data to clusters
-        self.labels_ = cluster_ics
+        return medoid_ics, cluster_ics
 
-        # Expose cluster centers, i.e. medoids
-        self.cluster_centers_ = X.take(medoid_ics, axis=0)
+    def _fastpam(self, D, medoid_ics):
+        """FastPAM2 swap phase, returns the medoid and cluster indices"""
 
-        # Return self to enable method chaining
-        return self
+        n = D.shape[0]
+        medoid_ics = np.array(medoid_ics)
+
+        self.n_iter_ = 0
+        while self.n_iter_ < self.max_iter:
+
+            self.n_iter_ += 1
+
+            nearest, d1, d2 = self._get_nearest_medoids(D, medoid_ics)
+
+            # Ignore improvements within floating point noise
+            tol = -1e-12 * max(np.sum(d1), 1)
+
+            # Best candidate (and its change of total deviation) for each medoid
+            best_delta = np.zeros(self.n_clusters)
+            best_candidate = np.full(self.n_clusters, -1)
+
+            is_medoid = np.zeros(n, dtype=bool)
+            is_medoid[medoid_ics] = True
+
+            for start in range(0, n, self.CHUNK_SIZE):
+                candidates = np.arange(start, min(start + self.CHUNK_SIZE, n))
+                candidates = candidates[~is_medoid[candidates]]
+                if len(candidates) == 0:
+                    continue
+
+                delta = self._get_swap_deltas(D.take(candidates, axis=0), nearest, d1, d2)
+
+                chunk_best = np.argmin(delta, axis=0)
+                chunk_delta = delta[chunk_best, np.arange(self.n_clusters)]
+                better = chunk_delta < best_delta
+                best_delta[better] = chunk_delta[better]
+                best_candidate[better] = candidates[chunk_best[better]]
+
+            # Perform the best swap, then the swaps found for the
+            # other medoids that still improve after it (FastPAM2)
+            swapped = False
+            for medoid_idx in np.argsort(best_delta):
+                candidate = best_candidate[medoid_idx]
+
+                if best_delta[medoid_idx] >= tol:
+                    break
+                if candidate in medoid_ics:
+                    continue
+
+                if swapped:
+                    nearest, d1, d2 = self._get_nearest_medoids(D, medoid_ics)
+                    delta = self._get_swap_deltas(D.take([candidate], axis=0), nearest, d1, d2)
+                    if delta[0, medoid_idx] >= tol:
+                        continue
+
+                medoid_ics[medoid_idx] = candidate
+                swapped = True
+
+            if not swapped:
+                break
+
+        nearest, d1, d2 = self._get_nearest_medoids(D, medoid_ics)
+
+        return medoid_ics, nearest
+
+    def _clara(self, X):
+        """
+        CLARA, returns the medoid and cluster indices.
+
+        FastPAM is run on random samples of X. The medoids of each sample are
+        scored on the whole X with the distances to those k medoids only.
+        The best medoids found so far are always part of the next sample.
+        """
+
+        n = X.shape[0]
+        sample_size = self.n_sampling or 40 + 2 * self.n_clusters
+        sample_size = max(min(sample_size, n), self.n_clusters)
+
+        best_cost = np.inf
+        best_medoid_ics = np.empty(0, dtype=int)
+
+        for _ in range(self.n_sampling_iter):
+
+            # Random sample that includes the best medoids
+            others = np.setdiff1d(np.arange(n), best_medoid_ics)
+            sample = self.random_state_.choice(others, sample_size - len(best_medoid_ics), replace=False)
+            sample = np.sort(np.concatenate((best_medoid_ics, sample)))
+
+            D_sample = self.distance_func(X[sample])
+            sample_medoid_ics = self._get_initial_medoid_indices(D_sample, self.n_clusters)
+            sample_medoid_ics, _ = self._fastpam(D_sample, sample_medoid_ics)
+            medoid_ics = sample[sample_medoid_ics]
+
+            # Score the sample medoids on the whole data
+            nearest, d1, _ = self._nearest_medoids(self.distance_func(X, X[medoid_ics]).T)
+            cost = np.sum(d1)
+
+            if cost < best_cost:
+                best_cost = cost
+                best_medoid_ics = medoid_ics
+                best_cluster_ics = nearest
+
+        self.n_iter_ = self.n_sampling_iter
+
+        return best_medoid_ics, best_cluster_ics
+
+    def _clarans(self, X):
+        """
+        CLARANS, returns the medoid and cluster indices.
+
+        Each restart begins with random medoids and tries swaps with random
+        points, keeping those that improve, until max_neighbor swaps in a row
+        don't. Only the distances from X to the current medoids are kept.
+        """
+
+        n = X.shape[0]
+        k = self.n_clusters
+        max_neighbor = self.max_neighbor or max(250, int(0.0125 * k * (n - k)))
+
+        best_cost = np.inf
+        self.n_iter_ = 0
+
+        for _ in range(self.num_local):
+
+            medoid_ics = self.random_state_.choice(n, k, replace=False)
+            D_medoids = self.distance_func(X, X[medoid_ics]).T
+            nearest, d1, d2 = self._nearest_medoids(D_medoids)
+
+            # Ignore improvements within floating point noise
+            tol = -1e-12 * max(np.sum(d1), 1)
+
+            tries = 0
+            while tries < max_neighbor and n > k:
+
+                medoid_idx = self.random_state_.randint(k)
+                candidate = self.random_state_.randint(n)
+                if candidate in medoid_ics:
+                    continue
+
+                tries += 1
+                self.n_iter_ += 1
+
+                D_candidate = self.distance_func(X[[candidate]], X)
+                delta = self._get_swap_deltas(D_candidate, nearest, d1, d2)
+
+                if delta[0, medoid_idx] < tol:
+                    medoid_ics[medoid_idx] = candidate
+                    D_medoids[medoid_idx] = D_candidate[0]
+                    nearest, d1, d2 = self._nearest_medoids(D_medoids)
+                    tries = 0
+
+            cost = np.sum(d1)
+            if cost < best_cost:
+                best_cost = cost
+                best_medoid_ics = np.copy(medoid_ics)
+                best_cluster_ics = nearest
+
+        return best_medoid_ics, best_cluster_ics
+
+    def _get_nearest_medoids(self, D, medoid_ics):
+        """
+        Returns the cluster index of the nearest medoid of every point,
+        and the distances to its nearest and second nearest medoids.
+        """
+
+        return self._nearest_medoids(D.take(medoid_ics, axis=0))
+
+    def _nearest_medoids(self, D_medoids):
+        """Same as _get_nearest_medoids, given the medoid rows of D"""
+
+        points = np.arange(D_medoids.shape[1])
+
+        order = np.argsort(D_medoids, axis=0)
+        nearest = order[0]
+        d1 = D_medoids[nearest, points]
+
+        if D_medoids.shape[0] > 1:
+            d2 = D_medoids[order[1], points]
+        else:
+            d2 = np.full(len(points), np.inf)
+
+        return nearest, d1, d2
+
+    def _get_swap_deltas(self, D_candidates, nearest, d1, d2):
+        """
+        Change of the total deviation when swapping each medoid with each candidate.
+
+        A point whose medoid is kept moves to the candidate if it is closer,
+        a point whose medoid is removed moves to the candidate or to its second
+        nearest medoid. The first part is shared by all the medoids.
+
+        Parameters
+        ----------
+        D_candidates : array, shape=(n_candidates, n_samples)
+            Distances from the candidates to every point.
+
+        Returns
+        -------
+        delta : array, shape=(n_candidates, n_clusters)
+        """
+
+        shared = np.minimum(D_candidates - d1, 0)
+        removed = np.minimum(D_candidates, d2) - d1 - shared
+
+        # Sum the removal term over the points of each medoid
+        one_hot = np.zeros((len(nearest), self.n_clusters))
+        one_hot[np.arange(len(nearest)), nearest] = 1
+
+        return np.sum(shared, axis=1)[:, None] + removed.dot(one_hot)
 
     def _check_array(self, X):
 
@@ -174,7 +463,7 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
         # Assign data points to clusters based on
         # which cluster assignment yields
         # the smallest distance
-        cluster_ics = np.argmin(D[medoid_ics, :], axis=0)
+        cluster_ics = np.argmin(D.take(medoid_ics, axis=0), axis=0)
 
         return cluster_ics
 
@@ -188,20 +477,21 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
                 warnings.warn("Cluster {} is empty!".format(cluster_idx))
                 continue
 
+            members = np.where(cluster_ics == cluster_idx)[0]
+
             # Find current cost that is associated with cluster_idx.
             # Cost is the sum of the distance from the cluster
             # members to the medoid.
-            curr_cost = np.sum(D[medoid_ics[cluster_idx],
-                                 cluster_ics == cluster_idx])
-
-            # Extract the distance matrix between the data points
-            # inside the cluster_idx
-            D_in = D[cluster_ics == cluster_idx, :]
-            D_in = D_in[:, cluster_ics == cluster_idx]
+            curr_cost = np.sum(D.take([medoid_ics[cluster_idx]], axis=0)[0, members])
 
             # Calculate all costs there exists between all
-            # the data points in the cluster_idx
-            all_costs = np.sum(D_in, axis=1)
+            # the data points in the cluster_idx, CHUNK_SIZE
+            # rows of the distance matrix at a time
+            all_costs = np.empty(len(members))
+            for start in range(0, len(members), self.CHUNK_SIZE):
+                rows = members[start:start + self.CHUNK_SIZE]
+                all_costs[start:start + len(rows)] = \
+                    np.sum(D.take(rows, axis=0)[:, members], axis=1)
 
             # Find the index for the smallest cost in cluster_idx
             min_cost_idx = np.argmin(all_costs)
@@ -217,8 +507,7 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
                 # Find data points that belong to cluster_idx,
                 # and assign the newly found medoid as the medoid
                 # for cluster c
-                medoid_ics[cluster_idx] = \
-                    np.where(cluster_ics == cluster_idx)[0][min_cost_idx]
+                medoid_ics[cluster_idx] = members[min_cost_idx]
 
     def transform(self, X):
         """Transforms X to cluster-distance space.
@@ -280,7 +569,46 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
 
             # Pick K first data points that have the smallest sum distance
             # to every other point. These are the initial medoids.
-            medoids = list(np.argsort(np.sum(D, axis=1))[:n_clusters])
+            medoids = list(np.argsort(D.sum(axis=1))[:n_clusters])
+
+        elif self.init == 'build':  # PAM BUILD
+
+            # Start from the most central point and greedily add
+            # the point that reduces the total deviation the most
+            medoids = [int(np.argmin(D.sum(axis=1)))]
+            d1 = D.take(medoids, axis=0)[0]
+
+            for _ in range(1, n_clusters):
+                best_gain = -1
+                for start in range(0, D.shape[0], self.CHUNK_SIZE):
+                    candidates = np.arange(start, min(start + self.CHUNK_SIZE, D.shape[0]))
+                    gain = np.sum(np.maximum(d1 - D.take(candidates, axis=0), 0), axis=1)
+                    gain[np.isin(candidates, medoids)] = -1
+
+                    if np.max(gain) > best_gain:
+                        best_gain = np.max(gain)
+                        best = candidates[np.argmax(gain)]
+
+                medoids.append(int(best))
+                d1 = np.minimum(d1, D.take([best], axis=0)[0])
+
+        elif self.init == 'k-medoids++':
+
+            # Pick a random first medoid, then sample the next ones with
+            # probability proportional to the distance to the nearest medoid
+            medoids = [self.random_state_.randint(D.shape[0])]
+            d1 = D.take(medoids, axis=0)[0]
+
+            for _ in range(1, n_clusters):
+                weights = np.copy(d1)
+                weights[medoids] = 0
+                if np.sum(weights) == 0:
+                    weights = np.ones(D.shape[0])
+                    weights[medoids] = 0
+
+                medoid = self.random_state_.choice(D.shape[0], p=weights / np.sum(weights))
+                medoids.append(int(medoid))
+                d1 = np.minimum(d1, D.take([medoid], axis=0)[0])
 
         else:
 
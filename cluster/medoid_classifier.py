@@ -0,0 +1,122 @@
+import numpy as np
+
+import filter
+import instrumentation
+import metrics.jaccard_minhash as jaccard_minhash
+
+# Tweets MinHashed and compared at once by predict
+BATCH_SIZE = 1000
+
+
+class MedoidClassifier:
+    """
+    Nearest medoid classifier for new tweets, from a clustering of MinHash distances.
+
+    Only the k medoid texts and their MinHash signatures are kept. New tweets
+    are cleaned as filter.filter_tweets does, MinHashed in batches and given the
+    label of the medoid with the most matching hash values, i.e. the smallest
+    jaccard_minhash_distance. Each tweet costs one MinHash and k signature
+    comparisons, whatever the size of the clustered corpus.
+
+    Parameters
+    ----------
+    medoid_texts : list of strings
+        Clean texts of the medoids, medoid i has label i.
+
+    shingle_length : int, optional, default: 2
+        The same used for the distance matrix.
+
+    art : boolean, optional, default: False
+        Remove articles, pronouns and prepositions from the new tweets.
+
+    terms_to_remove : list of string, optional, default: None
+        Terms removed from the new tweets.
+
+    Example
+    -------
+    kmedoids = KMedoids(2, distance_metric='precomputed').fit(D)
+    classifier = MedoidClassifier.from_kmedoids(kmedoids, texts)
+    labels = classifier.predict(new_texts)
+    """
+
+    def __init__(self, medoid_texts, shingle_length=2, art=False, terms_to_remove=None):
+
+        self.medoid_texts = list(medoid_texts)
+
+        self.shingle_length = shingle_length
+
+        self.art = art
+
+        self.terms_to_remove = terms_to_remove
+
+        # uint64 array, shape=(num_perm, k)
+        self.signatures = jaccard_minhash.minhash_signatures(self.medoid_texts, shingle_length).T.copy()
+
+    @classmethod
+    def from_kmedoids(cls, kmedoids, texts, shingle_length=2, art=False, terms_to_remove=None):
+        """
+        Classifier of a fitted KMedoids, labels are the same as kmedoids.labels_
+
+        :param kmedoids: KMedoids fitted on the distances of texts
+        :param texts: list of strings, the clean texts kmedoids was fitted on
+        """
+
+        medoid_texts = [texts[i] for i in kmedoids.medoid_indices_]
+
+        return cls(medoid_texts, shingle_length, art, terms_to_remove)
+
+    @property
+    def n_clusters(self):
+        return len(self.medoid_texts)
+
+    def clean(self, texts):
+        """Cleans raw texts as filter.filter_tweets"""
+
+        texts = filter.clean_batch(texts, self.terms_to_remove)
+        if self.art:
+            texts = [" ".join(filter.removerArtProPre(text)) for text in texts]
+
+        return texts
+
+    def match_counts(self, texts, clean=True):
+        """
+        Number of hash values each text shares with each medoid.
+
+        :param texts: list of strings
+        :param clean: boolean, optional, default: True
+            Clean the texts first, False if they already are
+        :return counts: int array, shape=(len(texts), n_clusters)
+        """
+
+        counts = np.empty((len(texts), self.n_clusters), dtype=np.int32)
+
+        with instrumentation.timer("medoid_classifier.match_counts"):
+            for start in range(0, len(texts), BATCH_SIZE):
+                batch = texts[start:start + BATCH_SIZE]
+                if clean:
+                    batch = self.clean(batch)
+
+                signatures = jaccard_minhash.minhash_signatures(batch, self.shingle_length).T
+                counts[start:start + len(batch)] = jaccard_minhash._count_matches(signatures, self.signatures)
+
+            instrumentation.count("tweets", len(texts))
+
+        return counts
+
+    def transform(self, texts, clean=True):
+        """
+        Jaccard MinHash distance from each text to each medoid.
+
+        :return D: float64 array, shape=(len(texts), n_clusters)
+        """
+
+        return 1 - self.match_counts(texts, clean) / self.signatures.shape[0]
+
+    def predict(self, texts, clean=True):
+        """
+        Label of the nearest medoid of each text.
+
+        :return labels: int array, shape=(len(texts),)
+        """
+
+        return np.argmax(self.match_counts(texts, clean), axis=1)
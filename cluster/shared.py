@@ -0,0 +1,132 @@
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from metrics.condensed import CondensedDistance
+
+# Input attached by this (worker) process: key -> (blocks, X)
+_attached = {}
+
+
+class SharedInput:
+    """
+    Read-only input matrix published once in shared memory.
+
+    Pickling a SharedInput only sends the names of its shared blocks, so it can
+    be passed to every task of a pool at no cost. Worker processes attach to the
+    blocks the first time they get it and keep them until another input arrives.
+
+    Supported inputs: numpy arrays, scipy.sparse matrices (shared as CSR) and
+    CondensedDistance.
+
+    Parameters
+    ----------
+    X : array-like, sparse matrix or CondensedDistance
+    """
+
+    def __init__(self, X):
+
+        if sparse.issparse(X):
+            X = X.tocsr()
+            self.kind = 'csr'
+            self.meta = X.shape
+            arrays = [X.data, X.indices, X.indptr]
+        elif isinstance(X, CondensedDistance):
+            self.kind = 'condensed'
+            self.meta = (X.n, X.num_perm, X.triangle)
+            arrays = [X.values]
+        else:
+            X = np.asarray(X)
+            self.kind = 'dense'
+            self.meta = None
+            arrays = [X]
+
+        self._X = X
+        self._blocks = []
+        self.specs = []
+
+        for array in arrays:
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self._blocks.append(block)
+            self.specs.append((block.name, array.dtype.str, array.shape))
+
+        self.key = self.specs[0][0]
+
+    @property
+    def nbytes(self):
+        """Bytes published in shared memory"""
+
+        return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, dtype, shape in self.specs)
+
+    def __getstate__(self):
+        return {'kind': self.kind, 'meta': self.meta, 'specs': self.specs, 'key': self.key}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self):
+        """Returns the input, attaching to the shared blocks if needed"""
+
+        if hasattr(self, '_X'):
+            return self._X
+
+        if self.key not in _attached:
+            _detach_all()
+
+            blocks = [_attach(name) for name, _, _ in self.specs]
+            arrays = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+                      for block, (_, dtype, shape) in zip(blocks, self.specs)]
+
+            if self.kind == 'csr':
+                X = sparse.csr_matrix(tuple(arrays), shape=self.meta)
+            elif self.kind == 'condensed':
+                X = CondensedDistance(arrays[0], *self.meta)
+            else:
+                X = arrays[0]
+
+            _attached[self.key] = (blocks, X)
+
+        return _attached[self.key][1]
+
+    def close(self):
+        """Releases the shared blocks. Only the process that published the input can close it"""
+
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+        self._blocks = []
+
+
+def _attach(name):
+    """Attaches to a shared block without tracking it, the publisher owns it"""
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers attached blocks in the resource tracker,
+        # which then reports them as leaked or unlinks them behind the publisher
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _detach_all():
+    """Drops the inputs attached by this process"""
+
+    while _attached:
+        blocks = _attached.popitem()[1][0]
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # Still referenced by a live array, released when it's collected
+                pass
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import Entity
+import filter
+import util
+
+# Part of the cache key, increase it when the filtering or the format changes
+CACHE_VERSION = 1
+
+# Bytes read at once when hashing the input file
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def filtered_tweets(inputfilepath, art=False, frequency=False, terms_to_remove=None,
+                    cache_dir=util.CACHE_DIR, batch=False):
+    """
+    Same as filter.filter_tweets_from_file, cached.
+
+    The filtered corpus is saved as memory-mappable .npy columns in a directory
+    named after a hash of the input file contents and the filter arguments, so
+    it is rebuilt automatically when any of them changes.
+
+    :param inputfilepath: string, required
+        Location path of the CSV tweets (see util.read_from_file)
+
+    :param art: boolean, optional, default: False
+        Remove articles, pronouns and prepositions
+
+    :param frequency: boolean, optional, default: False,
+        Remove less used words
+
+    :param terms_to_remove: list of string, optional, default: None
+        List of terms to remove from each tweet
+
+    :param cache_dir: string, optional, default: util.CACHE_DIR
+
+    :param batch: boolean, optional, default: False
+        Return an Entity.TweetBatch whose texts are memory-mapped from the cache
+
+    :return tweets: list of tweets cleaned and filtered
+    """
+
+    cachepath = os.path.join(cache_dir, cache_key(inputfilepath, art, frequency, terms_to_remove))
+
+    if not os.path.isdir(cachepath):
+        tweets = filter.filter_tweets(util.read_from_file(inputfilepath), art=art, frequency=frequency,
+                                      terms_to_remove=terms_to_remove)
+        save_tweets(tweets, cachepath)
+
+        return Entity.TweetBatch.from_tweets(tweets) if batch else tweets
+
+    print("Reading cache:", cachepath)
+    return load_batch(cachepath) if batch else load_tweets(cachepath)
+
+
+def cache_key(inputfilepath, art=False, frequency=False, terms_to_remove=None):
+    """Hash of the input file contents and the filter arguments"""
+
+    key = hashlib.sha1()
+    with open(inputfilepath, "rb") as inputFile:
+        for block in iter(lambda: inputFile.read(HASH_BLOCK_SIZE), b""):
+            key.update(block)
+
+    arguments = {'version': CACHE_VERSION, 'art': bool(art), 'frequency': bool(frequency),
+                 'terms_to_remove': sorted(set(terms_to_remove)) if terms_to_remove else None}
+    key.update(json.dumps(arguments, sort_keys=True).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def save_tweets(tweets, cachepath):
+    """
+    Saves tweets as columns in the cachepath directory:
+    ids and texts as UTF-8 buffers with offsets, types and labels as integer
+    codes whose values are listed in meta.json.
+    The directory is written aside and renamed when complete.
+    """
+
+    parent = os.path.dirname(os.path.abspath(cachepath))
+    os.makedirs(parent, exist_ok=True)
+    tmppath = tempfile.mkdtemp(dir=parent)
+
+    if isinstance(tweets, Entity.TweetBatch):
+        ids, texts = tweets.ids.tolist(), tweets.texts.tolist()
+        tw_types, tw_labels = tweets.types, tweets.labels
+    else:
+        ids, texts = [tw.id for tw in tweets], [tw.text for tw in tweets]
+        tw_types, tw_labels = [tw.tw_type for tw in tweets], [tw.label for tw in tweets]
+
+    try:
+        columns = {}
+        for name, values in (('id', [str(id) for id in ids]), ('text', texts)):
+            store = Entity.TextStore.from_strings(values)
+            columns[name + '_offsets'], columns[name + '_buffer'] = store.offsets, store.buffer
+
+        types, columns['types'] = util.get_codes(tw_types)
+        labels, columns['labels'] = util.get_codes(tw_labels)
+
+        for name, column in columns.items():
+            np.save(os.path.join(tmppath, name + ".npy"), column)
+
+        with open(os.path.join(tmppath, "meta.json"), "w", encoding='utf-8') as metaFile:
+            json.dump({'n': len(tweets), 'types': types, 'labels': _json_values(labels)}, metaFile)
+
+        os.rename(tmppath, cachepath)
+    except OSError:
+        # Another process saved the same corpus first
+        shutil.rmtree(tmppath, ignore_errors=True)
+        if not os.path.isdir(cachepath):
+            raise
+
+
+def load_columns(cachepath):
+    """
+    Returns the memory-mapped columns saved by save_tweets, and the
+    'types' and 'labels' values of their codes.
+    """
+
+    columns = {}
+    for name in ('id_offsets', 'id_buffer', 'text_offsets', 'text_buffer', 'types', 'labels'):
+        columns[name] = np.load(os.path.join(cachepath, name + ".npy"), mmap_mode='r')
+
+    with open(os.path.join(cachepath, "meta.json"), encoding="utf8") as metaFile:
+        meta = json.load(metaFile)
+
+    return columns, meta
+
+
+def load_tweets(cachepath):
+    """Returns the list of tweets saved by save_tweets"""
+
+    columns, meta = load_columns(cachepath)
+
+    ids = Entity.TextStore(columns['id_offsets'], columns['id_buffer']).tolist()
+    texts = Entity.TextStore(columns['text_offsets'], columns['text_buffer']).tolist()
+    types = [meta['types'][code] for code in columns['types'].tolist()]
+    labels = [meta['labels'][code] for code in columns['labels'].tolist()]
+
+    return [Entity.Tweet(ids[i], texts[i], types[i], labels[i]) for i in range(meta['n'])]
+
+
+def load_batch(cachepath):
+    """
+    Returns the tweets saved by save_tweets as an Entity.TweetBatch.
+    The texts are not copied, they stay memory-mapped.
+    """
+
+    columns, meta = load_columns(cachepath)
+
+    ids = Entity.TextStore(columns['id_offsets'], columns['id_buffer']).tolist()
+    texts = Entity.TextStore(columns['text_offsets'], columns['text_buffer'])
+    types = np.array(meta['types'])[columns['types']]
+    labels = np.array(meta['labels'], dtype=object)[columns['labels']]
+
+    return Entity.TweetBatch(ids, texts, types, labels)
+
+
+def _json_values(values):
+    """numpy scalars (e.g. cluster labels) as python values"""
+
+    return [value.item() if isinstance(value, np.generic) else value for value in values]
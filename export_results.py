@@ -1,17 +1,26 @@
 from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.pipeline import make_pipeline
-from time import time
 from cluster.eac import EAC
 from cluster.kmedoids import KMedoids
 from sklearn.cluster import KMeans
 import metrics.jaccard_minhash as metrics
 import util
-import filter
+import corpus_cache
 import warnings
 import json
+import multiprocessing
+import numpy as np
+import trials
+import reduction
+import instrumentation
+from functools import partial
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# Accepted trials per experiment, and maximum number of trials run to get them
+N_ACCEPTED = 100
+MAX_TRIALS = 1000
+
 def isAdable(table):
     for i in range(2):
         count = 0
@@ -22,29 +31,35 @@ def isAdable(table):
 
     return True
 
-def kmeans(eac, removeTerms, ngram):
+def save_class_sizes(types, type_ics, outputfilepath):
+    """
+    Saves the number of clustered tweets of each type, in the order of the rows of
+    the precision matrices, for calculate_precision to weight the accuracy with.
+    """
+
+    sizes = np.bincount(type_ics, minlength=len(types))
+    with open(outputfilepath, 'w') as outputFile:
+        json.dump({'types': [str(t) for t in types], 'sizes': sizes.tolist()}, outputFile)
+
+
+@instrumentation.timed("export_results.kmeans")
+def kmeans(eac, removeTerms, ngram, pool=None, n_workers=None, checkpoint=None, max_trials=MAX_TRIALS, seed=0,
+           reduction_method=None, n_components=reduction.N_COMPONENTS, classes=None):
     terms = ['lazaro', 'lázaro', 'baez', 'báez', 'carlitos']
 
     print('Filtering tweets')
-    tweets = util.read_from_file("dataset.csv")
     if removeTerms:
-        tweets = filter.filter_tweets(tweets, terms_to_remove=terms)
+        tweets = corpus_cache.filtered_tweets("dataset.csv", terms_to_remove=terms, batch=True)
     else:
-        tweets = filter.filter_tweets(tweets)
+        tweets = corpus_cache.filtered_tweets("dataset.csv", batch=True)
 
-    # Reduce tweets list length
+    # Reduce tweets list length, a view of the cached columns
     tweets = tweets[0:6300]
 
-    carlitos = 0
-    lazaro = 0
+    carlitos = int(np.count_nonzero(tweets.types == 'Carlitos'))
+    lazaro = len(tweets) - carlitos
 
-    data = []
-    for tw in tweets:
-        if tw.tw_type == 'Carlitos':
-            carlitos += 1
-        else:
-            lazaro += 1
-        data.append(tw.text)
+    data = tweets.texts.tolist()
 
     print(carlitos, lazaro)
 
@@ -59,150 +74,178 @@ def kmeans(eac, removeTerms, ngram):
     vectorizer = make_pipeline(hasher)
     X = vectorizer.fit_transform(data)
 
-    count = 0
-    precision_list = []
+    if reduction_method:
+        # Dense float32 features for every EAC and KMeans fit, computed once per corpus
+        print("Reducing to {} dimensions ({})...".format(n_components, reduction_method))
+        X = reduction.reduce_features_cached(X, data, reduction_method, n_components,
+                                             name="hashing ngram={}".format(bool(ngram)))
 
-    while count < 100:
+    types, type_ics = util.get_codes(tweets.types)
+    if classes:
+        save_class_sizes(types, type_ics, classes)
+    trial = partial(_kmeans_trial, eac, type_ics, len(types))
 
-        # Start timer
-        t0 = time()
+    return trials.run_trials(trial, X, n_accepted=N_ACCEPTED, max_trials=max_trials, seed=seed,
+                             accept=isAdable, checkpoint=checkpoint, pool=pool,
+                             n_workers=n_workers)
 
-        if eac:
 
-            clustering = EAC(30, min_k=2, max_k=10)
-            EAC_D = clustering.fit(X).distance_
+def _kmeans_trial(eac, type_ics, n_types, X, seed):
 
-            # Kmedoids over EAC_D
-            kmed = KMedoids(2, init='random', distance_metric="precomputed")
-            labels = kmed.fit(EAC_D).labels_
+    if eac:
 
-        else:
+        # Trials already run in parallel, EAC runs its iterations in the same process
+        clustering = EAC(30, min_k=2, max_k=10, n_jobs=1)
+        EAC_D = clustering.fit(X).distance_
 
-            km = KMeans(n_clusters=2, init='k-means++', n_init=1, max_iter=100)
-            labels = km.fit(X).labels_
+        # Kmedoids over EAC_D
+        kmed = KMedoids(2, init='random', distance_metric="precomputed", random_state=seed)
+        labels = kmed.fit(EAC_D).labels_
 
-        # Assign labels to tweets
-        for i in range(len(tweets)):
-            tweets[i].label = labels[i]
+    else:
 
-        print("Precision: ")
-        # Print precision
-        precision = util.precision(tweets)
+        km = KMeans(n_clusters=2, init='k-means++', n_init=1, max_iter=100, random_state=seed)
+        labels = km.fit(X).labels_
 
-        print("done in %0.3fs" % (time() - t0))
+    precision = util.precision_batch(type_ics, labels[None, :], n_types)[0].tolist()
 
-        if isAdable(precision):
-            precision_list.append(precision)
-            count += 1
+    print("Precision:", precision)
 
-    return precision_list
+    return precision
 
 
-def minhash(eac, shingle, removeTerms):
+@instrumentation.timed("export_results.minhash")
+def minhash(eac, shingle, removeTerms, pool=None, n_workers=None, checkpoint=None, max_trials=MAX_TRIALS, seed=0,
+            classes=None):
     terms = ['lazaro', 'lázaro', 'baez', 'báez', 'carlitos']
 
     print('Filtering tweets')
-    tweets = util.read_from_file("dataset.csv")
     if removeTerms:
-        tweets = filter.filter_tweets(tweets, terms_to_remove=terms)
+        tweets = corpus_cache.filtered_tweets("dataset.csv", terms_to_remove=terms, batch=True)
     else:
-        tweets = filter.filter_tweets(tweets)
+        tweets = corpus_cache.filtered_tweets("dataset.csv", batch=True)
 
-    # Reduce tweets list length
+    # Reduce tweets list length, a view of the cached columns
     tweets = tweets[0:6300]
 
-    carlitos = 0
-    lazaro = 0
+    carlitos = int(np.count_nonzero(tweets.types == 'Carlitos'))
+    lazaro = len(tweets) - carlitos
 
-    data = []
-    for tw in tweets:
-        if tw.tw_type == 'Carlitos':
-            carlitos += 1
-        else:
-            lazaro += 1
-        data.append(tw.text)
+    data = tweets.texts.tolist()
 
     print(carlitos, lazaro)
 
     # Extract text from tweets
-    X = [tw.text for tw in tweets]
-
-    # Start timer
-    t0 = time()
+    X = data
 
     print("Calculating distance matrix...")
-    D = metrics.jaccard_minhash_distance_mp(X, shingle_length=shingle)
+    with instrumentation.timer("export_results.distance", shingle=shingle):
+        D = metrics.jaccard_minhash_distance_cached(X, shingle_length=shingle, condensed=True)
 
-    count = 0
-    precision_list = []
+    types, type_ics = util.get_codes(tweets.types)
+    if classes:
+        save_class_sizes(types, type_ics, classes)
+    trial = partial(_minhash_trial, eac, type_ics, len(types))
 
-    while count < 100:
+    return trials.run_trials(trial, D, n_accepted=N_ACCEPTED, max_trials=max_trials, seed=seed,
+                             accept=isAdable, checkpoint=checkpoint, pool=pool,
+                             n_workers=n_workers)
 
-        if eac:
 
-            print("EAC clustering...")
-            # EAC clustering
-            kmedoid = KMedoids(init='random', distance_metric='precomputed')
-            clustering = EAC(30, min_k=2, max_k=10, clustering=kmedoid)
-            EAC_D = clustering.fit(D).distance_
+def _minhash_trial(eac, type_ics, n_types, D, seed):
 
-            # Kmedoids over EAC_D
-            kmed = KMedoids(2, init='random', distance_metric="precomputed")
-            labels = kmed.fit(EAC_D).labels_
+    if eac:
 
-        else:
-            kmedoid = KMedoids(2, init='random', distance_metric='precomputed')
+        print("EAC clustering...")
+        # EAC clustering, in the same process as the trial
+        kmedoid = KMedoids(init='random', distance_metric='precomputed')
+        clustering = EAC(30, min_k=2, max_k=10, clustering=kmedoid, n_jobs=1)
+        EAC_D = clustering.fit(D).distance_
 
-            print("Kmedoids clustering...")
-            labels = kmedoid.fit(D).labels_
+        # Kmedoids over EAC_D
+        kmed = KMedoids(2, init='random', distance_metric="precomputed", random_state=seed)
+        labels = kmed.fit(EAC_D).labels_
+
+    else:
+        kmedoid = KMedoids(2, init='random', distance_metric='precomputed', random_state=seed)
 
-        # Assign labels to tweets
-        for i in range(len(tweets)):
-            tweets[i].label = labels[i]
+        print("Kmedoids clustering...")
+        labels = kmedoid.fit(D).labels_
 
-        # Print precision
-        print("Precision: ")
-        precision = util.precision(tweets)
+    precision = util.precision_batch(type_ics, labels[None, :], n_types)[0].tolist()
 
-        if isAdable(precision):
-            print(count)
-            precision_list.append(precision)
-            count += 1
+    print("Precision:", precision)
 
-        print("done in %0.3fs" % (time() - t0))
+    return precision
 
-    return precision_list
 
 if __name__ == "__main__":
 
+    # Stage times, rates and memory of the parent and the workers
+    sinks = (instrumentation.JsonLinesSink('export_results.metrics.jsonl'), instrumentation.ConsoleSink())
+    instrumentation.enable(*sinks)
+
+    # Worker pool shared by the trials of every experiment
+    n_workers = max(multiprocessing.cpu_count() - 1, 1)
+    pool = multiprocessing.Pool(n_workers, initializer=instrumentation.enable,
+                                initargs=sinks)
+
+    # Finished trials are appended to a .trials.jsonl file next to each result file,
+    # running again resumes from it. Delete it when the dataset changes. The number
+    # of clustered tweets of each type goes to a .classes.json file, calculate_precision
+    # weights the accuracy with it.
+
     # EAC Kmeans
-    precision_list = kmeans(eac=True, removeTerms=True, ngram=False)
+    precision_list = kmeans(eac=True, removeTerms=True, ngram=False, pool=pool, n_workers=n_workers,
+                            checkpoint='N6300_100_eac_kmeans.trials.jsonl',
+                            classes='N6300_100_eac_kmeans.classes.json')
     with open('N6300_100_eac_kmeans.json', 'w') as myfile:
         json.dump(precision_list, myfile)
 
+    # EAC Kmeans over 300 SVD dimensions instead of the 2^20 hashed features
+    # precision_list = kmeans(eac=True, removeTerms=True, ngram=False, pool=pool, n_workers=n_workers,
+    #                         reduction_method='svd',
+    #                         checkpoint='N6300_100_eac_kmeans_svd.trials.jsonl',
+    #                         classes='N6300_100_eac_kmeans_svd.classes.json')
+    # with open('N6300_100_eac_kmeans_svd.json', 'w') as myfile:
+    #     json.dump(precision_list, myfile)
+
     # Con Term
-    precision_list = kmeans(eac=True, removeTerms=False, ngram=False)
+    precision_list = kmeans(eac=True, removeTerms=False, ngram=False, pool=pool, n_workers=n_workers,
+                            checkpoint='N6300_100_eac_kmeans_sinterm.trials.jsonl',
+                            classes='N6300_100_eac_kmeans_sinterm.classes.json')
     with open('N6300_100_eac_kmeans_sinterm.json', 'w') as myfile:
         json.dump(precision_list, myfile)
 
     # # MinHash
     # # Shingle 1
-    # precision_list = minhash(eac=False, shingle=1,removeTerms=True)
+    # precision_list = minhash(eac=False, shingle=1,removeTerms=True,
+    #                          classes='N6300_100_minhash_1shingle_sinterm.classes.json')
     # with open('N6300_100_minhash_1shingle_sinterm.json', 'w') as myfile:
     #     json.dump(precision_list, myfile)
     #
     # # Shingle 2
-    # precision_list = minhash(eac=False, shingle=2,removeTerms=True)
+    # precision_list = minhash(eac=False, shingle=2,removeTerms=True,
+    #                          classes='N6300_100_minhash_2shingle_sinterm.classes.json')
     # with open('N6300_100_minhash_2shingle_sinterm.json', 'w') as myfile:
     #     json.dump(precision_list, myfile)
     #
     # # EAC MinHash
     # # Shingle 1
-    # precision_list = minhash(eac=True, shingle=1,removeTerms=True)
+    # precision_list = minhash(eac=True, shingle=1,removeTerms=True, pool=pool, n_workers=n_workers,
+    #                          checkpoint='N6300_100_eac_minhash_1shingle_sinterm.trials.jsonl',
+    #                          classes='N6300_100_eac_minhash_1shingle_sinterm.classes.json')
     # with open('N6300_100_eac_minhash_1shingle_sinterm.json', 'w') as myfile:
     #     json.dump(precision_list, myfile)
     #
     # # Shingle 2
-    # precision_list = minhash(eac=True, shingle=2,removeTerms=True)
+    # precision_list = minhash(eac=True, shingle=2,removeTerms=True, pool=pool, n_workers=n_workers,
+    #                          checkpoint='N6300_100_eac_minhash_2shingle_sinterm.trials.jsonl',
+    #                          classes='N6300_100_eac_minhash_2shingle_sinterm.classes.json')
     # with open('N6300_100_eac_minhash_2shingle_sinterm.json', 'w') as myfile:
     #     json.dump(precision_list, myfile)
+
+    pool.close()
+    pool.join()
+
+    instrumentation.disable()
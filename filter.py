@@ -1,6 +1,9 @@
-import re, json, argparse, util
+import re, json, argparse, hashlib, multiprocessing, util, raw_processing, Entity, instrumentation
+import numpy as np
 from unicodedata import normalize
-from collections import defaultdict
+from collections import OrderedDict
+from vocabulary import Vocabulary
+import metrics.jaccard_minhash as jaccard_minhash
 
 #
 # usage: filter.py [-h] inputfile outputfile
@@ -8,10 +11,54 @@ from collections import defaultdict
 # Minimum allowed word frecuency
 MINIMUM_FREQUENCY = 0.0005
 
-
-def filter_tweets(tweets, outputfilepath=None, art=False, frequency=False, terms_to_remove=None):
+# Streaming mode: tweets cleaned per chunk and texts remembered for deduplication
+CHUNK_SIZE = 10000
+MAX_SEEN = 1000000
+
+# Texts per task of clean_batch workers
+CLEAN_CHUNK_SIZE = 2000
+
+# Url, RT, Mentions(@) and emoji, removed in a single pass
+_REMOVE_RE = re.compile(r"(rt)|(@[_A-Za-z0-9]+)|(\w+:\/\S+)|(http)|(https)|["
+                        u"\U0001F600-\U0001F64F"  # emoticons
+                        u"\U0001F300-\U0001F5FF"  # symbols & pictographs
+                        u"\U0001F680-\U0001F6FF"  # transport & map symbols
+                        u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
+                        u"\U00002600-\U000027b0"  # various
+                        "]+", flags=re.UNICODE)
+
+# Strange characters and white spaces, words are split by them
+_PUNCT_RE = re.compile(r'[\s!"#$%&\'()*\-/<=>¿?@\[\\\]^“_`{|},.;:…]+')
+
+_ART_PRO_PRE = frozenset(
+    # Preposiciones
+    ['a','ante','bajo','con','contra','de','desde','durante',
+     'en','entre','hacia','hasta','mediante','para','por','segun',
+     'sin','sobre','tras'] +
+    # Articulos
+    ['el','la','los','las','un','una','unos','unas','lo','al','del'] +
+    # Pronombres
+    ['yo','mi','conmigo','tu','vos','usted','ti','contigo','el','ella',
+     'ello','si','consigo','nosotros','nosotras','ustedes','ellos',
+     'ellas','si','consigo','vosotros','vosotras','me','nos','te','se',
+     'os','lo','la','le','los','las','les','mio','mia','mios','mias',
+     'tuyo','tuya','tuyos','tuyas','suyo','suya','su','suyas','suyos',
+     'nuestro','nuestra','nuestras','nuestros','vuestro','vuestros',
+     'vuestra','vuestras','suyo','suya','suyos','suyas','este','esta',
+     'esto','estos','estas','ese','esa','eso','esos','esas','aquel',
+     'aquella','aquello','aquellas','aquellos','que','cual','cuales',
+     'donde','quien','como','quienes','cuyo','cuyos','cuanto','cuanta',
+     'cuantos','cuantas','bastante','alguno','cualquiera','nadie',
+     'ninguno','otro','quienquiera'] +
+    # Varios
+    ['y','o','es','no','va','q','x','era'])
+
+
+@instrumentation.timed("filter.filter_tweets")
+def filter_tweets(tweets, outputfilepath=None, art=False, frequency=False, terms_to_remove=None, n_jobs=1,
+                  vocabulary=None, near_duplicates=None):
     """
-    :param tweets: list of Entity.Tweet, required
+    :param tweets: list of Entity.Tweet or Entity.TweetBatch, required
 
     :param outputfilepath: string, optional, default: None
         Location path for saving the filtered tweets
@@ -25,135 +72,317 @@ def filter_tweets(tweets, outputfilepath=None, art=False, frequency=False, terms
     :param terms_to_remove: list of string, optional, default: None
         List of terms to remove from each tweet
 
-    :return tweets: list of tweets cleaned and filtered
-    """
+    :param n_jobs: int, optional, default: 1
+        Number of processes used to clean the tweets, see clean_batch
 
-    if terms_to_remove:  # Remove search terms
-        for i in range(len(tweets)):
-            tweets[i].text = remove_search_terms(tweets[i].text.lower(), terms_to_remove)
+    :param vocabulary: Vocabulary, optional, default: None
+        Words kept by the frequency filter. If None, the words of the tweets
+        with a relative frequency of at least MINIMUM_FREQUENCY
 
-    # Clean tweets
-    for i in range(len(tweets)):
-        tweets[i].text = clean(tweets[i].text.lower())
+    :param near_duplicates: float, optional, default: None
+        Also remove the tweets whose MinHash jaccard similarity with a previous
+        tweet is equal or greater than this threshold. The ids of the removed
+        tweets, near duplicates and exact duplicates of either, are stored in the
+        duplicates list of the tweet that was kept
 
-    # Remove duplicated tweets
-    seen = set()
-    deduped = []
-    for i in range(len(tweets)):
-        if tweets[i].text not in seen:
-            seen.add(tweets[i].text)
-            deduped.append(tweets[i])
-    tweets = deduped
+    :return tweets: list of tweets cleaned and filtered, a TweetBatch if tweets is one
+    """
+
+    is_batch = isinstance(tweets, Entity.TweetBatch)
+
+    # Remove search terms and clean tweets
+    texts = clean_batch(tweets.texts.tolist() if is_batch else [tw.text for tw in tweets], terms_to_remove, n_jobs)
+
+    # Remove duplicated tweets, kept holds the indices of the remaining tweets and
+    # exact the indices of the tweets removed for having the same text as each of them
+    first = {}
+    kept = []
+    exact = []
+    for i in range(len(texts)):
+        k = first.get(texts[i])
+        if k is None:
+            first[texts[i]] = len(kept)
+            kept.append(i)
+            exact.append([])
+        else:
+            exact[k].append(i)
+
+    duplicates = None
+    if near_duplicates:  # Remove near duplicated tweets
+        ids = tweets.ids.tolist() if is_batch else [tw.id for tw in tweets]
+        representatives, groups = _near_duplicate_groups([texts[i] for i in kept], near_duplicates)
+
+        # Ids of the exact and near duplicates of each representative, in input order
+        duplicates = []
+        for k, group in zip(representatives, groups):
+            members = exact[k] + [i for j in group for i in [kept[j]] + exact[j]]
+            duplicates.append([ids[i] for i in sorted(members)])
+
+        kept = [kept[k] for k in representatives]
 
     if art:  # Remove articulos, pronombres y preposiciones
-        for i in range(len(tweets)):
-            tweets[i].text = " ".join(removerArtProPre(tweets[i].text))
+        for i in kept:
+            texts[i] = " ".join(removerArtProPre(texts[i]))
 
     if frequency:  # Remove less used words
-        # TODO review effectiveness
-        total = 0
-        d = defaultdict(int)
-        for tw in tweets:
-            for word in tw.text:
-                d[word] += 1
-                total += 1
-
-        freq_ord = [(word,count) for word, count in sorted(d.items(), key=lambda k_v: (k_v[1], k_v[0]),reverse=True)]
+        if vocabulary is None:
+            vocabulary = Vocabulary().fit(texts[i] for i in kept).prune(min_frequency=MINIMUM_FREQUENCY)
 
-        wordsFiltered = []
-        # freqFiltered = []
-
-        for i in range(len(freq_ord)):
-            if freq_ord[i][1]/total < MINIMUM_FREQUENCY:
-                wordsFiltered = [x[0] for x in freq_ord[:i]]
-                #  Only necessary if it's required to know the frequency of each word
-                # freqFiltered = [x[1] for x in freq_ord[:i]]
-                break
-
-        for i in range(len(tweets)):
-            tweets[i].text = ' '.join([x for x in tweets[i].text if x in wordsFiltered])
+        for i in kept:
+            texts[i] = vocabulary.filter(texts[i])
 
     # Remove empty tweets
-    super_cleaned = []
-    for tweet in tweets:
-        if len(tweet.text) != 0:
-            super_cleaned.append(tweet)
+    super_cleaned = [k for k, i in enumerate(kept) if len(texts[i]) != 0]
 
-    tweets = super_cleaned
-
-    if not tweets:
+    if not super_cleaned:
         raise Exception('There is no remaining tweet after filtering')
 
+    if duplicates is not None:
+        duplicates = [duplicates[k] for k in super_cleaned]
+    kept = [kept[k] for k in super_cleaned]
+
+    if is_batch:
+        tweets = tweets[np.array(kept)]
+        tweets.texts = [texts[i] for i in kept]
+        if duplicates is not None:
+            tweets.duplicates = duplicates
+    else:
+        filtered = []
+        for k, i in enumerate(kept):
+            tweets[i].text = texts[i]
+            if duplicates is not None:
+                tweets[i].duplicates = duplicates[k]
+            filtered.append(tweets[i])
+        tweets = filtered
+
     if outputfilepath:
         util.save_to_file(tweets, outputfilepath)
 
     return tweets
 
 
+def filter_tweets_stream(tweets, art=False, terms_to_remove=None, chunk_size=CHUNK_SIZE, max_seen=MAX_SEEN,
+                         n_jobs=1):
+    """
+    Streaming version of filter_tweets, in constant memory.
+    Tweets are read, cleaned and yielded chunk by chunk, so it can be chained
+    to raw_processing.iterjson/iterxml, util.iter_from_file and util.save_to_file.
+
+    Duplicates are detected with a digest of the last max_seen distinct texts.
+    The frequency filter needs the whole corpus, so it isn't available here.
+
+    :param tweets: iterable of Entity.Tweet, required
+
+    :param art: boolean, optional, default: False
+        Remove articles, pronouns and prepositions
+
+    :param terms_to_remove: list of string, optional, default: None
+        List of terms to remove from each tweet
+
+    :param chunk_size: int, optional, default: CHUNK_SIZE
+
+    :param max_seen: int, optional, default: MAX_SEEN
+
+    :param n_jobs: int, optional, default: 1
+        Number of processes used to clean each chunk, see clean_batch
+
+    :return tweets: generator of tweets cleaned and filtered
+    """
+
+    seen = _SeenTexts(max_seen)
+
+    for chunk in util.chunked(tweets, chunk_size):
+        instrumentation.count("tweets", len(chunk))
+
+        # Remove search terms and clean tweets
+        texts = clean_batch([tweet.text for tweet in chunk], terms_to_remove, n_jobs)
+
+        for tweet, text in zip(chunk, texts):
+
+            # Remove duplicated tweets
+            if not seen.add(text):
+                continue
+
+            if art:  # Remove articulos, pronombres y preposiciones
+                text = " ".join(removerArtProPre(text))
+
+            # Remove empty tweets
+            if len(text) != 0:
+                tweet.text = text
+                yield tweet
+
+
+class _SeenTexts:
+    """Set of the digests of the last max_size distinct texts"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.digests = OrderedDict()
+
+    def add(self, text):
+        """Adds text, returns False if it was already seen"""
+
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        if digest in self.digests:
+            self.digests.move_to_end(digest)
+            return False
+
+        self.digests[digest] = None
+        if len(self.digests) > self.max_size:
+            self.digests.popitem(last=False)
+
+        return True
+
+
+def filter_file_stream(inputfilepath, outputfilepath, format="csv", art=False, terms_to_remove=None):
+    """
+    Filters a tweet file into a CSV file in constant memory.
+
+    :param inputfilepath: string, required
+        Location path for loading the tweets
+
+    :param outputfilepath: string, required
+        Location path for saving the filtered tweets
+
+    :param format: string, optional, default: "csv"
+        "csv" for util.save_to_file files, "json" or "xml" for raw data
+
+    :param art: boolean, optional, default: False
+        Remove articles, pronouns and prepositions
+
+    :param terms_to_remove: list of string, optional, default: None
+        List of terms to remove from each tweet
+
+    :return count: number of tweets saved
+    """
+
+    if format == "csv":
+        tweets = util.iter_from_file(inputfilepath)
+    elif format == "xml":
+        tweets = raw_processing.iterxml(inputfilepath)
+    else:
+        tweets = raw_processing.iterjson(inputfilepath)
+
+    with instrumentation.timer("filter.filter_file_stream", format=format):
+        return util.save_to_file(filter_tweets_stream(tweets, art, terms_to_remove), outputfilepath)
+
+
+def remove_near_duplicates(tweets, threshold=0.8, shingle_length=2):
+    """
+    Returns the tweets that are not a near duplicate of a previous one.
+    Each kept tweet gets the list of ids of its near duplicates in tw.duplicates.
+
+    :param tweets: list of Entity.Tweet, required
+
+    :param threshold: float, optional, default: 0.8
+        Minimum MinHash jaccard similarity between near duplicates
+
+    :param shingle_length: int, optional, default: 2
+
+    :return tweets: list of tweets
+    """
+
+    kept, groups = _near_duplicate_groups([tw.text for tw in tweets], threshold, shingle_length)
+
+    for i, group in zip(kept, groups):
+        tweets[i].duplicates = [tweets[j].id for j in group]
+
+    return [tweets[i] for i in kept]
+
+
+def _near_duplicate_groups(texts, threshold=0.8, shingle_length=2):
+    """
+    Returns the indices of the texts that are not a near duplicate of a previous
+    one and, for each of them, the list of indices of its near duplicates
+    """
+
+    representative = jaccard_minhash.near_duplicates(texts, threshold, shingle_length)
+
+    kept = []
+    duplicates = {}
+    for i in range(len(texts)):
+        if representative[i] == i:
+            duplicates[i] = []
+            kept.append(i)
+        else:
+            duplicates[representative[i]].append(i)
+
+    return kept, [duplicates[i] for i in kept]
+
+
 def clean(text):
 
-    # Remove extra white spaces
-    text = " ".join(text.split())
-    
-    _punct_re = re.compile(r'[\t !"#$%&\'()*\-/<=>¿?@\[\\\]^“_`{|},.;:…]+')
-
-    # Remove url, RT, Mentions(@), "..."
-    text = re.sub(r"(rt)|(@[_A-Za-z0-9]+)|(\w+:\/\S+)|(http)|(https)", "", text)
-
-    emoji_pattern = re.compile("["
-                               u"\U0001F600-\U0001F64F"  # emoticons
-                               u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-                               u"\U0001F680-\U0001F6FF"  # transport & map symbols
-                               u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-                               u"\U00002600-\U000027b0"  # various
-                               "]+", flags=re.UNICODE)
-    text = emoji_pattern.sub(r'', text)  # no emoji
-    
-    # Remove strange characters
-    result = []
-    for word in _punct_re.split(text.lower()):        
-        word = normalize('NFKD', word)
-        # word = normalize('NFKD', word).encode('ascii',False)
-        # word = word.decode('utf-8')
-        if word:            
-            result.append(word)
+    # Remove url, RT, Mentions(@), "..." and emoji
+    text = _REMOVE_RE.sub("", text)
+
+    # Remove strange characters and extra white spaces
+    words = [word for word in _PUNCT_RE.split(text.lower()) if word]
+
+    # NFKD of the joined words is the same as of each word, white spaces aren't decomposed
+    return normalize('NFKD', " ".join(words))
+
+
+@instrumentation.timed("filter.clean_batch")
+def clean_batch(texts, terms_to_remove=None, n_jobs=1, chunk_size=CLEAN_CHUNK_SIZE):
+    """
+    Cleans many texts at once, the same as filter_tweets does with each tweet:
+    lower case, remove_search_terms (if terms_to_remove) and clean.
+
+    :param texts: list of string, required
+
+    :param terms_to_remove: list of string, optional, default: None
+        List of terms to remove from each text
+
+    :param n_jobs: int, optional, default: 1
+        Number of processes, -1 for all the processors.
+        The texts are sent to the workers in chunks of chunk_size
+
+    :param chunk_size: int, optional, default: CLEAN_CHUNK_SIZE
+
+    :return texts: list of cleaned strings
+    """
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+
+    terms = frozenset(terms_to_remove) if terms_to_remove else None
+    instrumentation.count("tweets", len(texts))
+
+    if n_jobs <= 1 or len(texts) <= chunk_size:
+        return _clean_chunk((texts, terms))
+
+    chunks = [(texts[i:i + chunk_size], terms) for i in range(0, len(texts), chunk_size)]
+    with multiprocessing.Pool(n_jobs) as pool:
+        cleaned = pool.map(_clean_chunk, chunks)
+
+    return [text for chunk in cleaned for text in chunk]
+
+
+def _clean_chunk(args):
+    texts, terms = args
+
+    if terms:
+        return [clean(_remove_terms(text.lower(), terms).lower()) for text in texts]
+
+    return [clean(text.lower()) for text in texts]
 
-    return " ".join(result)
-    
 
 def removerArtProPre(text):
-    preposiciones = ['a','ante','bajo','con','contra','de','desde','durante',
-                     'en','entre','hacia','hasta','mediante','para','por','segun',
-                     'sin','sobre','tras']    
-    
-    articulos = ['el','la','los','las','un','una','unos','unas','lo','al','del']
-    
-    pronombres = ['yo','mi','conmigo','tu','vos','usted','ti','contigo','el','ella',
-                  'ello','si','consigo','nosotros','nosotras','ustedes','ellos',
-                  'ellas','si','consigo','vosotros','vosotras','me','nos','te','se',
-                  'os','lo','la','le','los','las','les','mio','mia','mios','mias',
-                  'tuyo','tuya','tuyos','tuyas','suyo','suya','su','suyas','suyos',
-                  'nuestro','nuestra','nuestras','nuestros','vuestro','vuestros',
-                  'vuestra','vuestras','suyo','suya','suyos','suyas','este','esta',
-                  'esto','estos','estas','ese','esa','eso','esos','esas','aquel',
-                  'aquella','aquello','aquellas','aquellos','que','cual','cuales',
-                  'donde','quien','como','quienes','cuyo','cuyos','cuanto','cuanta',
-                  'cuantos','cuantas','bastante','alguno','cualquiera','nadie',
-                  'ninguno','otro','quienquiera']
-    varios = ['y','o','es','no','va','q','x','era']
-              
-    filtro = set(preposiciones+articulos+pronombres+varios)
-    
+
     result = []
     for word in text.split(' '):
-        if word not in filtro:
+        if word not in _ART_PRO_PRE:
             result.append(word)
     return result
 
 
 def remove_search_terms(text, terms):
 
-    filtro = set(terms)
+    return _remove_terms(text, set(terms))
+
+
+def _remove_terms(text, filtro):
+
     result = []
     for word in text.split(' '):
         if word not in filtro:
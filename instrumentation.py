@@ -0,0 +1,287 @@
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+#
+# Stage timing, counters and memory of the pipeline, reported to pluggable sinks.
+#
+# Example
+# -------
+# instrumentation.enable(instrumentation.JsonLinesSink("metrics.jsonl"), instrumentation.ConsoleSink())
+#
+# with instrumentation.timer("minhash.distance"):
+#     ...
+#     instrumentation.count("pairs", n_pairs)
+#
+# Nothing is measured until enable is called: timer returns a shared no-op
+# context manager and count returns at once, so instrumented code runs at full
+# speed. Every process has its own state, enable it in the workers (e.g. in a
+# pool initializer, or before forking) to get their stages too.
+
+# Seconds between two memory samples
+MEMORY_INTERVAL = 0.05
+
+_sinks = []
+
+# Timers entered and not exited, outermost first
+_active = []
+
+_sampler = None
+
+_lock = threading.Lock()
+
+
+def enable(*sinks, memory=True):
+    """
+    Starts reporting to sinks.
+
+    :param sinks: JsonLinesSink, LoggerSink, CallbackSink, ConsoleSink or any
+        object with an emit(record) method
+    :param memory: boolean, optional, default: True
+        Sample the resident memory every MEMORY_INTERVAL seconds in a thread,
+        to report the peak of each stage
+    """
+
+    global _sampler
+
+    disable()
+    _sinks.extend(sinks)
+
+    if memory and sinks:
+        _sampler = _MemorySampler()
+        _sampler.start()
+
+
+def disable():
+    """Stops reporting, timers become no-ops again"""
+
+    global _sampler
+
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler = None
+
+    del _sinks[:]
+
+
+def enabled():
+    return bool(_sinks)
+
+
+def timer(stage, **fields):
+    """
+    Context manager that reports the time, counters and peak memory of a stage.
+    fields are added to the report.
+    """
+
+    if not _sinks:
+        return _NULL_TIMER
+
+    return _Timer(stage, fields)
+
+
+def timed(stage):
+    """Decorator version of timer"""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+
+            with _Timer(stage, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    """Adds value to the counter name of every running stage, reported with its rate per second"""
+
+    if not _active:
+        return
+
+    for active in _active:
+        active.counters[name] = active.counters.get(name, 0) + value
+
+
+def progress(stage, done, total):
+    """Reports how much of a stage is done"""
+
+    if not _sinks:
+        return
+
+    _emit({'event': 'progress', 'stage': stage, 'done': done, 'total': total, 'pid': os.getpid()})
+
+
+def _emit(record):
+    for sink in _sinks:
+        sink.emit(record)
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+        self.counters = {}
+        self.peak_rss = 0
+
+    def __enter__(self):
+        self.peak_rss = _current_rss()
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        with _lock:
+            _active.append(self)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.t0
+        with _lock:
+            _active.remove(self)
+        self.peak_rss = max(self.peak_rss, _current_rss())
+
+        record = {'event': 'stage', 'stage': self.stage, 'start': self.start, 'seconds': seconds,
+                  'counters': self.counters,
+                  'rates': {name + '/s': value / seconds for name, value in self.counters.items() if seconds > 0},
+                  'peak_rss_mb': self.peak_rss / (1 << 20), 'pid': os.getpid()}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.fields)
+
+        if _sinks:
+            _emit(record)
+
+        return False
+
+
+class _MemorySampler(threading.Thread):
+    """Raises the peak memory of the running stages"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(MEMORY_INTERVAL):
+            rss = _current_rss()
+            with _lock:
+                for active in _active:
+                    active.peak_rss = max(active.peak_rss, rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _after_fork_in_child():
+    """
+    A fork copies the state of the parent, but not its sampler thread: the lock
+    may have been held by the sampler at the time of the fork and would never be
+    released, and the parent's running stages aren't the child's.
+    """
+
+    global _lock, _sampler
+
+    _lock = threading.Lock()
+    del _active[:]
+
+    if _sampler is not None:
+        _sampler = _MemorySampler()
+        _sampler.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _current_rss():
+    """Resident memory of this process in bytes"""
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # No procfs, the peak of the whole process is the best available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class JsonLinesSink:
+    """Appends every record to a file as a JSON line, workers can share it"""
+
+    def __init__(self, outputfilepath):
+        self.outputfilepath = outputfilepath
+
+    def emit(self, record):
+        if record['event'] == 'progress':
+            return
+
+        with open(self.outputfilepath, "a", encoding='utf-8') as outputFile:
+            outputFile.write(json.dumps(record) + "\n")
+
+
+class LoggerSink:
+    """Logs stage reports, and progress at DEBUG level"""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("twitter")
+        self.level = level
+
+    def emit(self, record):
+        if record['event'] == 'progress':
+            self.logger.debug("%s: %d/%d", record['stage'], record['done'], record['total'])
+            return
+
+        self.logger.log(self.level, "%s done in %0.3fs, peak %0.1f MB %s", record['stage'], record['seconds'],
+                        record['peak_rss_mb'], _format_rates(record))
+
+
+class CallbackSink:
+    """Calls callback(record) for every record"""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, record):
+        self.callback(record)
+
+
+class ConsoleSink:
+    """Progress bars and "done in" lines, on stdout"""
+
+    def emit(self, record):
+        if record['event'] == 'progress':
+            workdone = record['done'] / record['total'] if record['total'] else 1.0
+            print("\r{0}: [{1:50s}] {2:.1f}%".format(record['stage'], '#' * int(workdone * 50), workdone * 100),
+                  end="", flush=True)
+            if record['done'] == record['total']:
+                print('\n')
+            return
+
+        print("{} done in {:0.3f}s {}".format(record['stage'], record['seconds'], _format_rates(record)))
+
+
+def _format_rates(record):
+    return " ".join("{}={:0.0f}".format(name, rate) for name, rate in record['rates'].items())
@@ -0,0 +1,166 @@
+import numpy as np
+
+# Number of rows decoded at once by sum
+CHUNK_SIZE = 256
+
+
+class CondensedDistance:
+    """
+    Compact symmetric distance matrix with zero diagonal.
+
+    Only the upper triangle is stored, row by row, in condensed form (the same
+    layout as scipy.spatial.distance.squareform), or the lower triangle row by
+    row, where adding elements only appends their rows at the end (see
+    metrics.incremental). Values are either MinHash match
+    counts, decoded as (num_perm - count) / num_perm, or float32 distances. Rows are
+    decoded to float64 on demand, so it can be used where a precomputed n x n
+    matrix is expected (KMedoids, EAC) at 1/8 (float32) or 1/16 (uint8) of the memory.
+
+    Parameters
+    ----------
+    values : array, shape=(n * (n - 1) / 2,)
+        Condensed upper triangle.
+
+    n : int
+        Number of elements.
+
+    num_perm : int, optional, default: None
+        If given, values are match counts out of num_perm hash values.
+
+    triangle : {'upper', 'lower'}, optional, default: 'upper'
+        Stored triangle.
+    """
+
+    TRIANGLES = ['upper', 'lower']
+
+    def __init__(self, values, n, num_perm=None, triangle='upper'):
+
+        if triangle not in self.TRIANGLES:
+            raise ValueError("triangle must be one of {}".format(self.TRIANGLES))
+
+        if len(values) != n * (n - 1) // 2:
+            raise ValueError("values must have n * (n - 1) / 2 elements, " +
+                             "got {} for n = {}".format(len(values), n))
+
+        self.values = values
+
+        self.n = n
+
+        self.num_perm = num_perm
+
+        self.triangle = triangle
+
+        # Start of each row in values
+        rows = np.arange(n, dtype=np.int64)
+        if triangle == 'upper':
+            self._offsets = rows * n - rows * (rows + 1) // 2
+        else:
+            self._offsets = rows * (rows - 1) // 2
+
+    @staticmethod
+    def counts_dtype(num_perm):
+        """Smallest unsigned type that holds match counts up to num_perm"""
+
+        return np.dtype(np.uint8 if num_perm <= np.iinfo(np.uint8).max else np.uint16)
+
+    @classmethod
+    def empty_counts(cls, n, num_perm, triangle='upper'):
+        """Zero-filled match counts"""
+
+        return cls(np.zeros(n * (n - 1) // 2, dtype=cls.counts_dtype(num_perm)), n, num_perm, triangle)
+
+    @classmethod
+    def from_dense(cls, D, dtype=np.float32, triangle='upper'):
+        """Condensed float copy of a triangle of the dense matrix D"""
+
+        n = D.shape[0]
+        condensed = cls(np.empty(n * (n - 1) // 2, dtype=dtype), n, triangle=triangle)
+        for i in range(n):
+            condensed.row_segment(i)[:] = D[i, i + 1:] if triangle == 'upper' else D[i, :i]
+
+        return condensed
+
+    @property
+    def shape(self):
+        return self.n, self.n
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def __len__(self):
+        return self.n
+
+    def _decode(self, values):
+        if self.num_perm is None:
+            return values.astype(np.float64)
+
+        return (self.num_perm - values) / self.num_perm
+
+    def row_segment(self, i):
+        """Stored values of row i, i.e. columns i + 1 to n - 1 (upper) or 0 to i - 1 (lower)"""
+
+        start = self._offsets[i]
+
+        if self.triangle == 'upper':
+            return self.values[start:start + self.n - i - 1]
+
+        return self.values[start:start + i]
+
+    def row(self, i):
+        """Distances from element i to every element"""
+
+        D = np.zeros(self.n)
+
+        if self.triangle == 'upper':
+            # Columns j < i are stored in row j, column i
+            columns = np.arange(i)
+            D[:i] = self._decode(self.values[self._offsets[columns] + i - columns - 1])
+            D[i + 1:] = self._decode(self.row_segment(i))
+        else:
+            # Columns j > i are stored in row j, column i
+            columns = np.arange(i + 1, self.n)
+            D[:i] = self._decode(self.row_segment(i))
+            D[i + 1:] = self._decode(self.values[self._offsets[columns] + i])
+
+        return D
+
+    def take(self, indices, axis=0):
+        """Dense float64 rows (or columns, the matrix is symmetric) of the given indices"""
+
+        if axis not in (0, 1):
+            raise ValueError("axis must be 0 or 1")
+
+        indices = np.asarray(indices)
+        D = np.empty((len(indices), self.n))
+        for k, i in enumerate(indices):
+            D[k] = self.row(i)
+
+        return D if axis == 0 else D.T
+
+    def sum(self, axis=None):
+        """Sum of all the distances, or of each row/column"""
+
+        if axis is None:
+            return 2 * np.sum(self._decode(self.values))
+
+        sums = np.empty(self.n)
+        for start in range(0, self.n, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, self.n)
+            sums[start:stop] = np.sum(self.take(np.arange(start, stop)), axis=1)
+
+        return sums
+
+    def toarray(self):
+        """Dense float64 n x n matrix"""
+
+        D = np.zeros((self.n, self.n))
+        for i in range(self.n):
+            if self.triangle == 'upper':
+                D[i, i + 1:] = self._decode(self.row_segment(i))
+                D[i + 1:, i] = D[i, i + 1:]
+            else:
+                D[i, :i] = self._decode(self.row_segment(i))
+                D[:i, i] = D[i, :i]
+
+        return D
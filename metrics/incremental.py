@@ -0,0 +1,204 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import instrumentation
+import metrics.jaccard_minhash as jaccard_minhash
+from metrics.condensed import CondensedDistance
+
+
+class IncrementalDistance:
+    """
+    MinHash jaccard distance matrix of a corpus that grows as tweets are added.
+
+    Match counts are stored as a lower triangle CondensedDistance, where the
+    rows of new tweets go after the existing ones, together with the signature
+    of every tweet. append only MinHashes the new tweets and compares them with
+    every tweet (old and new), so adding m tweets to n costs m * (n + m)
+    signature comparisons and nothing already stored is moved.
+
+    In memory, the buffers grow by doubling their capacity. With a path, the
+    counts and signatures are appended to files in that directory and read
+    memory-mapped; meta.json holds the number of tweets and is replaced last,
+    so an interrupted append leaves the store as it was before it.
+
+    Parameters
+    ----------
+    path : string, optional, default: None
+        Directory of the store, opened if it exists.
+
+    shingle_length : int, optional, default: 2
+
+    Example
+    -------
+    store = IncrementalDistance(".cache/corpus")
+    store.append(todays_texts)
+    KMedoids(2, distance_metric='precomputed').fit(store.distance)
+    """
+
+    def __init__(self, path=None, shingle_length=2):
+
+        self.path = path
+
+        self.shingle_length = shingle_length
+
+        self.num_perm = jaccard_minhash.NUM_PERM
+
+        self.n = 0
+
+        self._dtype = CondensedDistance.counts_dtype(self.num_perm)
+
+        if path is None:
+            self._counts = np.empty(0, dtype=self._dtype)
+            self._signatures = np.empty((0, self.num_perm), dtype=np.uint64)
+        elif os.path.exists(self._file("meta.json")):
+            self._open()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._save_meta()
+
+    @classmethod
+    def from_matrix(cls, D, signatures, path=None, shingle_length=2):
+        """
+        Store holding an already computed matrix, e.g. from jaccard_minhash_distance_cached.
+        The matrix is copied once, no signature is compared.
+
+        :param D: dense distance matrix or CondensedDistance
+        :param signatures: uint64 array, shape=(n, num_perm), from minhash_signatures
+        """
+
+        store = cls(path, shingle_length)
+        if store.n:
+            raise ValueError("The store at {} isn't empty".format(path))
+
+        rows = [np.rint((1 - D[i, :i]) * store.num_perm) if isinstance(D, np.ndarray) else
+                np.rint((1 - D.row(i)[:i]) * store.num_perm) for i in range(D.shape[0])]
+        store._write(np.concatenate(rows).astype(store._dtype) if rows else np.empty(0, dtype=store._dtype),
+                     np.asarray(signatures, dtype=np.uint64))
+
+        return store
+
+    @property
+    def distance(self):
+        """CondensedDistance of match counts, lower triangle"""
+
+        if self.path is None:
+            values = self._counts[:self.n * (self.n - 1) // 2]
+        else:
+            values = self._map("counts.bin", self._dtype, (self.n * (self.n - 1) // 2,))
+
+        return CondensedDistance(values, self.n, self.num_perm, triangle='lower')
+
+    @property
+    def signatures(self):
+        """uint64 array, shape=(n, num_perm)"""
+
+        if self.path is None:
+            return self._signatures[:self.n]
+
+        return self._map("signatures.bin", np.uint64, (self.n, self.num_perm))
+
+    @instrumentation.timed("minhash.distance_append")
+    def append(self, data):
+        """
+        Adds the texts of data at the end of the matrix.
+
+        :param data: list of strings
+        :return self:
+        """
+
+        m = len(data)
+        if m == 0:
+            return self
+
+        n = self.n
+        new_signatures = jaccard_minhash.minhash_signatures(data, self.shingle_length)
+
+        # Signatures of every tweet, one permutation per row
+        all_signatures = np.ascontiguousarray(np.concatenate((self.signatures, new_signatures)).T)
+
+        rows = []
+        for start in range(0, m, jaccard_minhash.BLOCK_SIZE):
+            stop = min(start + jaccard_minhash.BLOCK_SIZE, m)
+
+            # New rows [n + start, n + stop) against the columns before them
+            counts = jaccard_minhash._count_matches(all_signatures[:, n + start:n + stop],
+                                                    all_signatures[:, :n + stop])
+            for k in range(stop - start):
+                rows.append(counts[k, :n + start + k].astype(self._dtype))
+
+        instrumentation.count("pairs", m * n + m * (m - 1) // 2)
+
+        self._write(np.concatenate(rows), new_signatures)
+
+        return self
+
+    def _write(self, counts, signatures):
+        """Appends the counts of the rows of the new tweets and their signatures"""
+
+        n = self.n + len(signatures)
+
+        if self.path is None:
+            self._counts = _grow(self._counts, n * (n - 1) // 2)
+            self._signatures = _grow(self._signatures, n)
+            self._counts[self.n * (self.n - 1) // 2:n * (n - 1) // 2] = counts
+            self._signatures[self.n:n] = signatures
+        else:
+            for name, array in (("counts.bin", counts), ("signatures.bin", signatures)):
+                with open(self._file(name), "ab") as outputFile:
+                    outputFile.write(np.ascontiguousarray(array).tobytes())
+                    outputFile.flush()
+                    os.fsync(outputFile.fileno())
+
+        self.n = n
+
+        if self.path is not None:
+            self._save_meta()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _map(self, name, dtype, shape):
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype)
+
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=shape)
+
+    def _open(self):
+
+        with open(self._file("meta.json"), encoding="utf8") as metaFile:
+            meta = json.load(metaFile)
+
+        if meta['shingle_length'] != self.shingle_length or meta['num_perm'] != self.num_perm:
+            raise ValueError("The store at {} has shingle_length {} and num_perm {}".format(
+                self.path, meta['shingle_length'], meta['num_perm']))
+
+        self.n = meta['n']
+
+        # Drop what an interrupted append wrote after the last saved meta.json
+        sizes = {"counts.bin": self.n * (self.n - 1) // 2 * self._dtype.itemsize,
+                 "signatures.bin": self.n * self.num_perm * np.dtype(np.uint64).itemsize}
+        for name, size in sizes.items():
+            with open(self._file(name), "ab") as dataFile:
+                dataFile.truncate(size)
+
+    def _save_meta(self):
+
+        fd, tmppath = tempfile.mkstemp(dir=self.path, suffix=".json")
+        with os.fdopen(fd, "w") as metaFile:
+            json.dump({'n': self.n, 'num_perm': self.num_perm, 'shingle_length': self.shingle_length}, metaFile)
+        os.replace(tmppath, self._file("meta.json"))
+
+
+def _grow(array, length):
+    """array, or a copy with at least twice its capacity if it can't hold length rows"""
+
+    if length <= len(array):
+        return array
+
+    grown = np.empty((max(length, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+
+    return grown
@@ -1,17 +1,47 @@
 import numpy as np
+import ctypes
+import hashlib
 import multiprocessing
+import os
+from scipy import sparse
 from datasketch.minhash import MinHash
-from functools import partial
+try:
+    from datasketch.minhash import _fmix, _SCHEME_WIDTHS
+except ImportError:
+    # datasketch < 2 only has the legacy permutations
+    _fmix = _SCHEME_WIDTHS = None
+from metrics.condensed import CondensedDistance
+import instrumentation
+import util
 
 # Constants
-MAX_SLICES = 8
+# MinHash parameters
+NUM_PERM = 128
+SEED = 1
 
+# Number of tiles per processor, so faster workers pick up the remaining ones
+TILES_PER_PROCESSOR = 4
 
-class PartialDist:
-    def __init__(self, X=None, Y=None, matrix=None):
-        self.X = X
-        self.Y = Y
-        self.matrix = matrix
+# Number of rows compared at once by the vectorized engine
+BLOCK_SIZE = 256
+
+# Number of candidate pairs verified at once by the LSH mode
+CANDIDATE_BATCH = 100000
+
+# Number of texts whose signatures are computed at once by minhash_signatures,
+# bounds its (num_perm, shingles of the batch) temporaries
+SIGNATURE_BATCH = 2000
+
+# Legacy datasketch permutations: (a * h + b) mod MERSENNE_PRIME, truncated to 32 bits
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Hash function, permutations and initial hash values of every signature
+_REFERENCE = MinHash(num_perm=NUM_PERM, seed=SEED)
+
+# Weight of false negatives when choosing the LSH bands and rows for near duplicates.
+# Candidates are verified, so false positives only cost time
+NEAR_DUPLICATES_FN_WEIGHT = 0.9
 
 
 def _extract_shingles(string, shingle_length=2):
@@ -30,7 +60,7 @@ def _extract_shingles(string, shingle_length=2):
 def _generate_minhash_list(data, shingle_length=2):
     minhash_list = []
     for text in data:
-        m = MinHash()
+        m = MinHash(num_perm=NUM_PERM, seed=SEED)
         for d in _extract_shingles(text, shingle_length):
             m.update(d.encode('utf8'))
         minhash_list.append(m)
@@ -38,186 +68,621 @@ def _generate_minhash_list(data, shingle_length=2):
     return minhash_list
 
 
-def jaccard_minhash_distance(data, shingle_length=2):
+def _match_counts_block(signatures, rows, columns):
+    """
+    Returns the number of equal hash values between every pair of the given rows and columns.
+
+    :param signatures: uint64 array, shape=(num_perm, n)
+    :param rows: slice of data's elements
+    :param columns: slice of data's elements
+    :return counts: int32 array, shape=(len(rows), len(columns))
+    """
+    return _count_matches(signatures[:, rows], signatures[:, columns])
+
+
+def _count_matches(row_sig, column_sig):
+    """
+    Returns the number of equal hash values between every pair of row_sig and column_sig elements.
+
+    :param row_sig: array, shape=(num_perm, n_rows)
+    :param column_sig: array, shape=(num_perm, n_columns)
+    :return counts: int32 array, shape=(n_rows, n_columns)
+    """
+    # Count matching hash values one permutation at a time
+    counts = np.zeros((row_sig.shape[1], column_sig.shape[1]), dtype=np.int32)
+    for k in range(row_sig.shape[0]):
+        counts += row_sig[k][:, None] == column_sig[k][None, :]
+
+    return counts
+
+
+@instrumentation.timed("minhash.signatures")
+def minhash_signatures(data, shingle_length=2, n_jobs=1):
+    """
+    Returns the MinHash signature of each of data's elements, one per row,
+    to be used as X with jaccard_signature_distance.
+
+    Signatures are the same as the hashvalues of the datasketch MinHash of
+    _generate_minhash_list, computed in batches of SIGNATURE_BATCH texts: each
+    distinct shingle of a batch is hashed once and every permutation is applied
+    to all of them at once, then reduced to the minimum of each text.
+
+    :param data: list of strings
+    :param shingle_length: int, optional, default: 2
+    :param n_jobs: int, optional, default: 1
+        Number of processes the batches are split across, -1 for all the processors
+    :return X: uint64 array, shape=(n, num_perm)
+    """
+    instrumentation.count("tweets", len(data))
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+
+    batches = [(data[start:start + SIGNATURE_BATCH], shingle_length)
+               for start in range(0, len(data), SIGNATURE_BATCH)]
+
+    if n_jobs <= 1 or len(batches) <= 1:
+        signatures = [_batch_signatures(batch) for batch in batches]
+    else:
+        with multiprocessing.Pool(min(n_jobs, len(batches))) as pool:
+            signatures = pool.map(_batch_signatures, batches)
+
+    if not signatures:
+        return np.empty((0, NUM_PERM), dtype=np.uint64)
+
+    return np.concatenate(signatures)
+
+
+def _signatures(data, shingle_length=2):
+    """
+    minhash_signatures transposed to shape (num_perm, n), so that each permutation
+    is a contiguous row, which is what _jaccard_distance_block iterates over
+    """
+
+    return np.ascontiguousarray(minhash_signatures(data, shingle_length).T)
+
+
+def _batch_signatures(args):
+    """MinHash signatures of a batch of texts, shape=(len(texts), num_perm)"""
+
+    texts, shingle_length = args
+
+    # Index of each distinct shingle, and the shingles of each text as indices
+    index = {}
+    shingle_ics = []
+    bounds = [0]
+    for text in texts:
+        for shingle in _extract_shingles(text, shingle_length):
+            shingle_ics.append(index.setdefault(shingle, len(index)))
+        bounds.append(len(shingle_ics))
+
+    hashes = [_REFERENCE.hashfunc(shingle.encode('utf8')) for shingle in index]
+    permuted = _permute(hashes)
+
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint64)
+    signatures[:] = _REFERENCE.hashvalues
+
+    # Minimum of the permuted hashes of each text with shingles
+    bounds = np.array(bounds)
+    starts = bounds[:-1][bounds[1:] > bounds[:-1]]
+    if len(starts):
+        minimums = np.minimum.reduceat(permuted[:, shingle_ics], starts, axis=1)
+        signatures[bounds[1:] > bounds[:-1]] = minimums.T
+
+    return signatures
+
+
+def _permute(hashes):
+    """
+    The num_perm permutations of MinHash.update applied to every hash value
+
+    :param hashes: list of int, values of _REFERENCE.hashfunc
+    :return permuted: array, shape=(num_perm, len(hashes))
+    """
+
+    a, b = _REFERENCE.permutations
+    a, b = a[:, None], b[:, None]
+    scheme = getattr(_REFERENCE, 'scheme', 'legacy')
+
+    if scheme == 'legacy':
+        hashes = np.array(hashes, dtype=np.uint64)[None, :]
+        return np.bitwise_and((a * hashes + b) % MERSENNE_PRIME, MAX_HASH)
+
+    # Affine permutations, wrapping around modulo 2^width, of the mixed hash values
+    hashes = _fmix(np.array(hashes, dtype=a.dtype), _SCHEME_WIDTHS[scheme])[None, :]
+    return a * hashes + b
+
+
+def jaccard_signature_distance(X, Y=None):
+    """
+    Jaccard distance between MinHash signatures, with the sklearn pairwise
+    distances interface, e.g. KMedoids(distance_metric=jaccard_signature_distance).
+
+    :param X: array, shape=(n_samples_X, num_perm)
+    :param Y: array, shape=(n_samples_Y, num_perm), optional, default: None (X)
+    :return D: float64 array, shape=(n_samples_X, n_samples_Y)
+    """
+    X = np.ascontiguousarray(np.asarray(X).T)
+    Y = X if Y is None else np.ascontiguousarray(np.asarray(Y).T)
+
+    if X.shape[0] != Y.shape[0]:
+        raise ValueError("X and Y must have the same number of hash values")
+
+    return 1 - _count_matches(X, Y) / X.shape[0]
+
+
+def _jaccard_distance_block(signatures, rows, columns):
+    """
+    Returns the jaccard distance between every pair of the given rows and columns.
+
+    The estimate is the number of equal hash values divided by num_perm, the
+    same as MinHash.jaccard, so the values are identical to the per-pair ones.
+
+    :param signatures: uint64 array, shape=(num_perm, n)
+    :param rows: slice of data's elements
+    :param columns: slice of data's elements
+    :return D: float64 array, shape=(len(rows), len(columns))
+    """
+    return 1 - _match_counts_block(signatures, rows, columns) / signatures.shape[0]
+
+
+def _store_condensed_rows(D, counts, start):
+    """
+    Stores the upper triangle part of a block of match counts in D.
+
+    :param D: CondensedDistance
+    :param counts: block of rows [start, start + len(counts)) and columns [start, n)
+    :param start: int
+    """
+    for k in range(counts.shape[0]):
+        D.row_segment(start + k)[:] = counts[k, k + 1:]
+
+
+@instrumentation.timed("minhash.distance")
+def jaccard_minhash_distance(data, shingle_length=2, condensed=False):
     """
     Calculate and return the jaccard distance matrix of all data's elements.
 
     :param data: list of strings
     :param shingle_length: int, optional, default: 2
+    :param condensed: boolean, optional, default: False
+        Return a CondensedDistance of match counts instead of a dense matrix
     :return D:
     """
     n = len(data)
-    D = np.zeros((n, n))
+    total = n
 
-    # Progress bar initialization
-    total = n-1
-    increment = int(0.02 * total)
-    if int(0.02 * total) == 0:
-        increment = 1
+    instrumentation.progress("minhash.distance", 0, total)
 
-    _progress(0, n)
+    # Pregenerating minhash signatures
+    signatures = _signatures(data, shingle_length)
 
-    # Pregenerating minhash objects
-    minhash_list = _generate_minhash_list(data, shingle_length)
+    if condensed:
+        D = CondensedDistance.empty_counts(n, signatures.shape[0])
+    else:
+        D = np.zeros((n, n))
 
-    # Calculate jaccard distance in a upper triangular matrix
-    for i in range(n - 1):
-        for j in range(i + 1, n):
+    # Calculate jaccard distance in a upper triangular matrix, BLOCK_SIZE rows at a time
+    for start in range(0, n, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n)
 
-            D[i, j] = 1 - minhash_list[i].jaccard(minhash_list[j])
+        if condensed:
+            counts = _match_counts_block(signatures, slice(start, stop), slice(start, n))
+            _store_condensed_rows(D, counts, start)
+        else:
+            block = _jaccard_distance_block(signatures, slice(start, stop), slice(start, n))
 
-        # Report progress
-        if i % increment == 0:
-            _progress(i, total)
+            # Discard the diagonal and the lower triangle of the block
+            block[:, :stop - start] = np.triu(block[:, :stop - start], 1)
+            D[start:stop, start:] = block
 
-    # Transform matrix into a symmetrical matrix
-    D += D.T
+        # Pairs of the rows [start, stop)
+        instrumentation.count("pairs", (stop - start) * (2 * n - start - stop - 1) // 2)
+        instrumentation.progress("minhash.distance", stop, total)
 
-    # End progress bar
-    _progress(total, total)
+    # Transform matrix into a symmetrical matrix
+    if not condensed:
+        D += D.T
 
     return D
 
 
-def jaccard_minhash_distance_mp(data, shingle_length=2):
+@instrumentation.timed("minhash.distance_mp")
+def jaccard_minhash_distance_mp(data, shingle_length=2, condensed=False):
     """
     Multiprocessing version.
     Calculate and return the jaccard distance matrix of all data's elements.
 
-    If the number of data's elements doesn't meet the criteria described in
-    the function get_number_sections(n) or if there is only one processor, the single
-    core jaccard_minhash_distance is executed.
+    The upper triangle is split in row tiles with the same number of pairs.
+    The signatures and the distance matrix live in shared memory: workers read
+    the former and write their tile (and its transpose) straight into the latter.
+
+    If there is only one processor, the single core jaccard_minhash_distance is executed.
 
     :param data: list of strings
     :param shingle_length: int, optional, default: 2
+    :param condensed: boolean, optional, default: False
+        Return a CondensedDistance of match counts instead of a dense matrix
     :return D:
     """
 
     n = len(data)
     n_processors = multiprocessing.cpu_count()
-    n_sections, n_slices = _get_number_sections(n)
 
-    # If there is only one processor or 'n' is not divisible by (2, MAX_SLICES), execute single core version
-    if n_processors == 1 or not n_sections:
-        return jaccard_minhash_distance(data, shingle_length=shingle_length)
+    # If there is only one processor, execute single core version
+    if n_processors == 1:
+        return jaccard_minhash_distance(data, shingle_length=shingle_length, condensed=condensed)
 
-    # Setup Multiprocessing
-    pool = multiprocessing.Pool(n_processors)
+    # Pregenerating minhash signatures
+    signatures = _signatures(data, shingle_length)
+    num_perm = signatures.shape[0]
 
-    # Start Progress bar
-    _progress(0, n_sections)
+    # Publish signatures and output matrix in shared memory
+    shared_signatures = multiprocessing.RawArray(ctypes.c_uint64, num_perm * n)
+    np.frombuffer(shared_signatures, dtype=np.uint64)[:] = signatures.ravel()
+    if condensed:
+        ctype = np.ctypeslib.as_ctypes_type(CondensedDistance.counts_dtype(num_perm))
+        shared_D = multiprocessing.RawArray(ctype, n * (n - 1) // 2)
+    else:
+        shared_D = multiprocessing.RawArray(ctypes.c_double, n * n)
 
-    # Pregenerating minhash objects
-    minhash_list = _generate_minhash_list(data, shingle_length)
+    bounds = _get_tile_bounds(n, n_processors * TILES_PER_PROCESSOR)
+    tiles = list(zip(bounds[:-1], bounds[1:]))
 
-    func = partial(_jac_minh_worker, minhash_list, n_slices, shingle_length)
+    # Setup Multiprocessing
+    pool = multiprocessing.Pool(n_processors, initializer=_init_shared,
+                                initargs=(shared_signatures, shared_D, num_perm, n, condensed))
 
-    dist_list = []
+    instrumentation.count("bytes_shared", ctypes.sizeof(shared_signatures) + ctypes.sizeof(shared_D))
+    instrumentation.progress("minhash.distance_mp", 0, len(tiles))
 
-    # Execute jobs and store partial_dist
-    for i, partial_dist in enumerate(pool.imap_unordered(func, range(n_sections))):
-        _progress(i, n_sections)
-        dist_list.append(partial_dist)
+    # Execute jobs, the tiles are written in shared_D
+    for i, _ in enumerate(pool.imap_unordered(_jac_minh_worker, tiles)):
+        instrumentation.progress("minhash.distance_mp", i + 1, len(tiles))
 
     pool.close()
     pool.join()
 
-    # End Progress bar
-    _progress(n_sections, n_sections)
+    instrumentation.count("pairs", n * (n - 1) // 2)
 
-    # Create and update final distance matrix
-    D = np.zeros((n, n))
-    section_lenght = int(n / n_slices)
+    if condensed:
+        return CondensedDistance(np.ctypeslib.as_array(shared_D), n, num_perm)
 
-    for partial_dist in dist_list:
-        X = partial_dist.X
-        Y = partial_dist.Y
-        D[X * section_lenght: ((X + 1) * section_lenght), Y * section_lenght: ((Y + 1) * section_lenght)] = partial_dist.matrix
+    return np.frombuffer(shared_D).reshape(n, n)
 
-    ind_low = np.tril_indices(n)
-    D[ind_low] = 0
-    D += D.T
 
-    return D
+# Shared memory views of the worker processes
+_shared = {}
 
 
-def _jac_minh_worker(minhash_data, n_slices, shingle_length, i):
-    """
-    Given n = length (data)
-    Returns a submatrix of the n x n final distance matrix
+def _init_shared(signatures, D, num_perm, n, condensed):
+    """Pool initializer, wraps the shared buffers as numpy arrays"""
 
-    :param minhash_data: list of strings
-    :param n_slices: int
-    :param shingle_length: int
-    :param i:
-    :return partial_dist: PartialDist
-    """
+    _shared['signatures'] = np.frombuffer(signatures, dtype=np.uint64).reshape(num_perm, n)
+    if condensed:
+        _shared['D'] = CondensedDistance(np.ctypeslib.as_array(D), n, num_perm)
+    else:
+        _shared['D'] = np.frombuffer(D).reshape(n, n)
 
-    # Initialization
-    n = len(minhash_data)
-    section_lenght = int(n / n_slices)
-    X, Y = _get_coord_section(i+1, n_slices)
-    D = np.zeros((section_lenght, section_lenght))
 
-    # Create distance submatrix according to number of worker (i)
-    row = 0
-    column = 0
-    for i in range(X * section_lenght, ((X + 1) * section_lenght)):
-        for j in range(Y * section_lenght, ((Y + 1) * section_lenght)):
-            if i < j:
-                D[row, column] = 1 - minhash_data[i].jaccard(minhash_data[j])
+def _jac_minh_worker(tile):
+    """
+    Given n = length (data)
+    Writes the rows [start, stop) of the upper triangle of the n x n final
+    distance matrix, and their transpose, into the shared matrix.
+    If the shared matrix is a CondensedDistance, only the match counts of the
+    upper triangle are written.
 
-            column += 1
-        row += 1
-        column = 0
+    :param tile: (start, stop) rows
+    :return stop - start: number of rows written
+    """
 
-    return PartialDist(X, Y, D)
+    signatures = _shared['signatures']
+    D = _shared['D']
+    n = signatures.shape[1]
+    start, stop = tile
 
+    for row in range(start, stop, BLOCK_SIZE):
+        row_stop = min(row + BLOCK_SIZE, stop)
 
-def _get_coord_section(k, n_slices):
-    """ Returns PartialDist's coordinates according to the number of worker
+        if isinstance(D, CondensedDistance):
+            counts = _match_counts_block(signatures, slice(row, row_stop), slice(row, n))
+            _store_condensed_rows(D, counts, row)
+            continue
 
-    :return i: X coordinate
-    :return j: Y coordinate
+        # The block is symmetric where it overlaps the diagonal
+        block = _jaccard_distance_block(signatures, slice(row, row_stop), slice(row, n))
+        D[row:row_stop, row:] = block
+        D[row:, row:row_stop] = block.T
 
-    """
-    count = 0
-    for i in range(0, n_slices):
-        for j in range(i, n_slices):
-            count += 1
-            if count == k:
-                return i, j
+    return stop - start
 
 
-def _get_number_sections(n):
+def _get_tile_bounds(n, n_tiles):
     """
-    Get number of sections according to number of elements n
-    It checks if n is divisible by the numbers in the range (2, MAX_SLICES) and if the
-    length of the generated slices is 2 or more.
+    Get the row bounds of n_tiles tiles of the upper triangle of a n x n
+    matrix, each one with the same number of pairs (up to rounding).
 
-    Returns the maximum possible number of n_sections.
+    The first r rows hold r * n - r^2 / 2 pairs, so the bound of the k-th
+    tile is n * (1 - sqrt(1 - k / n_tiles)).
 
     Parameters
     ----------
     :param n: number of elements
+    :param n_tiles: int
 
     Returns
     -------
-    :return n_sections: int
-    :return n_slices: int
+    :return bounds: int array, from 0 to n
     """
-    for i in range(MAX_SLICES, 2, -1):
-        n_sections = i * (i + 1) / 2
+    fractions = np.arange(n_tiles + 1) / n_tiles
+    bounds = np.round(n * (1 - np.sqrt(1 - fractions))).astype(int)
 
-        if n % i == 0 and n / i > 1:
-            return int(n_sections), i
+    # Drop empty tiles
+    return np.unique(bounds)
 
-    return None, None
 
+def jaccard_minhash_distance_lsh(data, shingle_length=2, threshold=0.5, bands=32, rows=4):
+    """
+    Sparse version.
+    Calculate and return the jaccard distance of the pairs of data's elements
+    whose similarity is equal or greater than threshold.
+
+    The MinHash signatures are split in bands of rows hash values, and only the
+    pairs that share a bucket in at least one band are compared. Pairs below the
+    threshold, or that never share a bucket, are not stored. Stored pairs with a
+    distance of 0 (duplicates) are kept as explicit zeros, as in the
+    sklearn sparse distance graphs. The share of the pairs above threshold
+    expected to be found (lsh_expected_recall) is reported with the stage.
+
+    :param data: list of strings
+    :param shingle_length: int, optional, default: 2
+    :param threshold: float, optional, default: 0.5
+        Minimum jaccard similarity of the stored pairs
+    :param bands: int, optional, default: 32
+    :param rows: int, optional, default: 4
+        Number of hash values per band. bands * rows must not exceed num_perm
+    :return D: scipy.sparse.csr_matrix, shape=(n, n)
+    """
+    n = len(data)
+
+    if bands * rows > NUM_PERM:
+        raise ValueError("bands * rows ({}) ".format(bands * rows) +
+                         "can't be larger than num_perm ({})".format(NUM_PERM))
+
+    with instrumentation.timer("minhash.distance_lsh",
+                               expected_recall=lsh_expected_recall(threshold, bands, rows)):
+        # Pregenerating minhash signatures
+        signatures = _signatures(data, shingle_length)
+        num_perm = signatures.shape[0]
+
+        I, J, counts = _lsh_similar_pairs(signatures, threshold, bands, rows, stage="minhash.distance_lsh")
+        distances = 1 - counts / num_perm
+
+        # Symmetrical sparse matrix
+        D = sparse.csr_matrix((np.concatenate((distances, distances)),
+                               (np.concatenate((I, J)), np.concatenate((J, I)))), shape=(n, n))
+
+    return D
+
+
+def _lsh_similar_pairs(signatures, threshold, bands, rows, stage=None):
+    """
+    Returns the pairs of elements that share a bucket in at least one band and
+    whose estimated jaccard similarity is equal or greater than threshold.
+
+    :param signatures: uint64 array, shape=(num_perm, n)
+    :param stage: string, optional, default: None
+        Stage the progress of the bands is reported as, if any
+    :return I, J, counts: int arrays, pairs i < j sorted by i then j, and their number of equal hash values
+    """
+    n = signatures.shape[1]
+    num_perm = signatures.shape[0]
+
+    if stage:
+        instrumentation.progress(stage, 0, bands)
+
+    # Collect the candidate pairs of every band, encoded as i * n + j with i < j
+    candidates = []
+    for band in range(bands):
+        candidates.append(_lsh_band_candidates(signatures[band * rows:(band + 1) * rows]))
+        if stage:
+            instrumentation.progress(stage, band + 1, bands)
+
+    candidates = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+    instrumentation.count("pairs", len(candidates))
+    I = candidates // n
+    J = candidates % n
 
-def _progress(count, total):
-    workdone = count/total
+    # Verify the candidates with the full signatures
+    counts = np.empty(len(candidates), dtype=np.int64)
+    for start in range(0, len(candidates), CANDIDATE_BATCH):
+        stop = start + CANDIDATE_BATCH
+        counts[start:stop] = np.count_nonzero(signatures[:, I[start:stop]] == signatures[:, J[start:stop]], axis=0)
+
+    keep = counts >= threshold * num_perm
+
+    return I[keep], J[keep], counts[keep]
+
+
+def _lsh_band_candidates(band_signatures):
+    """
+    Returns the pairs of elements that fall in the same bucket of one band.
+
+    :param band_signatures: uint64 array, shape=(rows, n)
+    :return pairs: int64 array of i * n + j codes, with i < j
+    """
+    n = band_signatures.shape[1]
+
+    # Each element's band is hashed to a bucket id
+    keys = np.ascontiguousarray(band_signatures.T)
+    keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    _, buckets, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+    buckets = buckets.ravel()
+
+    # Group the elements by bucket
+    order = np.argsort(buckets, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+
+    pairs = []
+    for bucket in np.where(sizes > 1)[0]:
+        members = order[bounds[bucket]:bounds[bucket + 1]]
+        i, j = np.triu_indices(len(members), 1)
+        pairs.append(members[i].astype(np.int64) * n + members[j])
+
+    if not pairs:
+        return np.empty(0, dtype=np.int64)
+
+    return np.concatenate(pairs)
+
+
+def near_duplicates(data, threshold=0.8, shingle_length=2, bands=None, rows=None):
+    """
+    Find the near duplicates of data's elements, in roughly linear time.
+
+    Candidate pairs come from banded LSH over the MinHash signatures and are kept
+    if their estimated jaccard similarity is equal or greater than threshold.
+    Elements are visited in order: an element that is not a duplicate of a
+    previous one is kept, and its unassigned near duplicates are assigned to it.
+
+    :param data: list of strings
+    :param threshold: float, optional, default: 0.8
+    :param shingle_length: int, optional, default: 2
+    :param bands: int, optional, default: None
+    :param rows: int, optional, default: None
+        If bands or rows is None, they are chosen for threshold by lsh_params,
+        favouring recall
+    :return representative: int array, index of the kept element each element is a duplicate of
+        (its own index if it is kept)
+    """
+    n = len(data)
+    signatures = _signatures(data, shingle_length)
+    num_perm = signatures.shape[0]
+
+    if bands is None or rows is None:
+        bands, rows = lsh_params(threshold, num_perm, 1 - NEAR_DUPLICATES_FN_WEIGHT, NEAR_DUPLICATES_FN_WEIGHT)
+
+    I, J, _ = _lsh_similar_pairs(signatures, threshold, bands, rows)
+
+    representative = np.arange(n)
+
+    # Pairs are sorted by I, then J
+    for i, j in zip(I.tolist(), J.tolist()):
+        if representative[i] == i and representative[j] == j:
+            representative[j] = i
+
+    return representative
+
+
+def lsh_params(threshold, num_perm, false_positive_weight=0.5, false_negative_weight=0.5):
+    """
+    Returns the bands and rows, with bands * rows <= num_perm, that minimize the weighted
+    probability of false positives (similarity < threshold) and false negatives.
+
+    :param threshold: float
+    :param num_perm: int
+    :return bands, rows: int, int
+    """
+    steps = 200
+    below = (np.arange(steps) + 0.5) * threshold / steps
+    above = threshold + (np.arange(steps) + 0.5) * (1 - threshold) / steps
+
+    best = None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positive = np.mean(lsh_candidate_probability(below, bands, rows)) * threshold
+            false_negative = np.mean(1 - lsh_candidate_probability(above, bands, rows)) * (1 - threshold)
+            error = false_positive_weight * false_positive + false_negative_weight * false_negative
+
+            if best is None or error < best[0]:
+                best = (error, bands, rows)
+
+    return best[1], best[2]
+
+
+def lsh_candidate_probability(similarity, bands, rows):
+    """
+    Probability that a pair with the given jaccard similarity shares a bucket in at least one band.
+
+    :param similarity: float or array of floats
+    :param bands: int
+    :param rows: int
+    :return probability: float or array of floats
+    """
+    return 1 - (1 - np.power(similarity, rows)) ** bands
+
+
+def lsh_expected_recall(threshold, bands, rows):
+    """
+    Expected fraction of the pairs with similarity equal or greater than
+    threshold that are found by jaccard_minhash_distance_lsh, assuming
+    their similarity is uniformly distributed between threshold and 1.
+
+    :param threshold: float
+    :param bands: int
+    :param rows: int
+    :return recall: float
+    """
+    # Midpoint rule over [threshold, 1]
+    steps = 1000
+    similarity = threshold + (np.arange(steps) + 0.5) * (1 - threshold) / steps
+
+    return float(np.mean(lsh_candidate_probability(similarity, bands, rows)))
+
+
+@instrumentation.timed("minhash.distance_cached")
+def jaccard_minhash_distance_cached(data, shingle_length=2, condensed=False, signatures=False,
+                                    cache_dir=util.CACHE_DIR, mp=True):
+    """
+    Cached version.
+    Returns the jaccard distance matrix of all data's elements from cache_dir, computing
+    and saving it first if needed. The matrix is saved as .npy, keyed by a hash of data,
+    shingle_length, NUM_PERM and SEED, and loaded memory-mapped (read-only), so several
+    processes share the same pages.
+
+    :param data: list of strings
+    :param shingle_length: int, optional, default: 2
+    :param condensed: boolean, optional, default: False
+        Cache and return a CondensedDistance of match counts instead of a dense matrix
+    :param signatures: boolean, optional, default: False
+        Also cache and return the MinHash signatures, shape=(n, num_perm)
+    :param cache_dir: string, optional, default: util.CACHE_DIR
+    :param mp: boolean, optional, default: True
+        Use jaccard_minhash_distance_mp when the matrix is not cached
+    :return D: or (D, signatures) if signatures is True
+    """
+    key = os.path.join(cache_dir, _cache_key(data, shingle_length))
+    D_path = key + ("_condensed.npy" if condensed else "_dense.npy")
+
+    if os.path.exists(D_path):
+        instrumentation.count("cache_hits")
+    else:
+        distance = jaccard_minhash_distance_mp if mp else jaccard_minhash_distance
+        D = distance(data, shingle_length=shingle_length, condensed=condensed)
+        util.save_npy(D.values if condensed else D, D_path)
+        del D
+
+    D = np.load(D_path, mmap_mode='r')
+    if condensed:
+        D = CondensedDistance(D, len(data), NUM_PERM)
+
+    if not signatures:
+        return D
+
+    S_path = key + "_signatures.npy"
+    if not os.path.exists(S_path):
+        util.save_npy(minhash_signatures(data, shingle_length), S_path)
+
+    return D, np.load(S_path, mmap_mode='r')
+
+
+def _cache_key(data, shingle_length):
+    """Hash of data and of the MinHash parameters"""
+
+    key = hashlib.sha1("{} {} {}".format(shingle_length, NUM_PERM, SEED).encode('utf8'))
+    for text in data:
+        text = text.encode('utf8')
+        key.update(len(text).to_bytes(8, 'little'))
+        key.update(text)
 
-    print("\rProgress: [{0:50s}] {1:.1f}%".format('#' * int(workdone * 50), workdone * 100), end="", flush=True)
-    if count == total:
-        print('\n')
+    return key.hexdigest()
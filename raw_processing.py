@@ -1,6 +1,8 @@
-import json, argparse, Entity, util
+import json, argparse, Entity, util, instrumentation
 import xml.etree.ElementTree as ET
 
+# Number of tweets per chunk in streaming mode
+CHUNK_SIZE = 10000
 
 #
 # usage: raw_processing.py [-h] [-f FORMAT] inputfile outputfile
@@ -10,13 +12,23 @@ def main(inputfilepath, outputfilepath, format):
     return get_processed_tweets(inputfilepath, outputfilepath, format)
 
 
-def get_processed_tweets(inputfilepath, outputfilepath = None, format = "JSON"):
+# Returns the tweets as a list, or as an Entity.TweetBatch if batch
+def get_processed_tweets(inputfilepath, outputfilepath = None, format = "JSON", batch = False):
 
-    # Read raw data
-    if format == "xml":
-        tweets = readxml(inputfilepath)
-    else:
-        tweets = readjson(inputfilepath)
+    with instrumentation.timer("raw_processing.read", format=format):
+
+        # Read raw data
+        if format == "xml":
+            tweets = iterxml(inputfilepath)
+        else:
+            tweets = iterjson(inputfilepath)
+
+        if batch:
+            tweets = Entity.TweetBatch.from_tweets(tweets)
+        else:
+            tweets = list(tweets)
+
+        instrumentation.count("tweets", len(tweets))
 
     if outputfilepath:
         util.save_to_file(tweets, outputfilepath)
@@ -24,10 +36,26 @@ def get_processed_tweets(inputfilepath, outputfilepath = None, format = "JSON"):
     return tweets
 
 
+# Yields chunks (lists) of up to chunk_size tweets, reading the raw data lazily
+def get_processed_tweets_stream(inputfilepath, format="JSON", chunk_size=CHUNK_SIZE):
+
+    if format == "xml":
+        tweets = iterxml(inputfilepath)
+    else:
+        tweets = iterjson(inputfilepath)
+
+    return util.chunked(tweets, chunk_size)
+
+
 # Returns a list of tweets from json
 def readjson(inputfilepath):
+
+    return list(iterjson(inputfilepath))
+
+
+# Yields the tweets of a json file, one json object per line
+def iterjson(inputfilepath):
     print("Reading JSON")
-    tweets = []
     try:
 
         with open(inputfilepath, "r") as input_file:
@@ -38,17 +66,21 @@ def readjson(inputfilepath):
                 # Since sometimes there are objects other than tweets (limits,etc)
                 if "id" in tweet.keys():
                     tw = Entity.Tweet(tweet["id"],tweet["text"])
-                    tweets.append(tw)
+                    yield tw
 
     except Exception as e:
         print("error: {0}".format(e))
 
-    return tweets
-
 
 # Returns a list of tweets from xml
 def readxml(inputfilepath):
 
+    return list(iterxml(inputfilepath))
+
+
+# Yields the tweets of a xml file without building the whole tree
+def iterxml(inputfilepath):
+
     print("Reading XML")
 
     # XML fields
@@ -56,18 +88,27 @@ def readxml(inputfilepath):
     TEXT = "content"
     TWEET = "tweet"
 
-    tweets = []
-    tree = ET.parse(inputfilepath)
-    root = tree.getroot()
+    context = ET.iterparse(inputfilepath, events=("start", "end"))
+    _, root = next(context)
 
-    for tweet in root.findall(TWEET):
-        tw = Entity.Tweet()
-        tw.id = tweet.find(ID).text
-        tw.text = tweet.find(TEXT).text
+    depth = 0
+    for event, element in context:
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
 
-        tweets.append(tw)
+        # Only the tweets that are children of the root, as root.findall(TWEET)
+        if depth == 0:
+            if element.tag == TWEET:
+                tw = Entity.Tweet()
+                tw.id = element.find(ID).text
+                tw.text = element.find(TEXT).text
 
-    return tweets
+                yield tw
+
+            # Free the parsed elements
+            root.clear()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+from sklearn.random_projection import SparseRandomProjection
+
+import instrumentation
+import util
+
+# Dimensions of the reduced features
+N_COMPONENTS = 300
+
+METHODS = ['svd', 'random_projection']
+
+
+def reduce_features(X, method='svd', n_components=N_COMPONENTS, random_state=0):
+    """
+    Projects the sparse, high dimensional features of the tweets (e.g. from
+    HashingVectorizer) to n_components dense float32 dimensions, normalized
+    to unit length as the hashed features are.
+
+    'svd' keeps the directions of largest variance (latent semantic analysis),
+    'random_projection' is a sparse random projection, faster to compute and
+    preserving the distances between tweets up to a small distortion.
+
+    :param X: sparse matrix, shape=(n_samples, n_features)
+    :param method: {'svd', 'random_projection'}, optional, default: 'svd'
+    :param n_components: int, optional, default: N_COMPONENTS
+    :param random_state: int, optional, default: 0
+    :return X: float32 array, shape=(n_samples, n_components)
+    """
+
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(METHODS))
+
+    with instrumentation.timer("reduction.reduce_features", method=method, n_components=n_components):
+        # Hashed features use a few of their columns, the empty ones don't change the
+        # result but would make the SVD components n_features long
+        X = sparse.csr_matrix(X)
+        X = X[:, np.unique(X.indices)]
+
+        if method == 'svd':
+            # There can't be more components than used columns
+            reducer = TruncatedSVD(min(n_components, X.shape[1] - 1), random_state=random_state)
+        else:
+            reducer = SparseRandomProjection(n_components, dense_output=True, random_state=random_state)
+
+        reduced = normalize(reducer.fit_transform(X)).astype(np.float32)
+        instrumentation.count("tweets", X.shape[0])
+
+    return reduced
+
+
+def reduce_features_cached(X, texts, method='svd', n_components=N_COMPONENTS, random_state=0, name="",
+                           cache_dir=util.CACHE_DIR):
+    """
+    Cached version of reduce_features, keyed by a hash of the texts, name (the
+    settings that built X from them) and the reduction parameters. The reduction
+    is saved as .npy and loaded memory-mapped (read-only).
+
+    :param texts: list of strings, the texts X was built from
+    :param name: string, optional, default: ""
+        Description of how X was built, e.g. "hashing ngram=(1, 3)"
+    """
+
+    key = hashlib.sha1("{} {} {} {}".format(name, method, n_components, random_state).encode('utf8'))
+    for text in texts:
+        key.update(text.encode('utf8'))
+        key.update(b"\0")
+
+    path = os.path.join(cache_dir, "reduced_" + key.hexdigest() + ".npy")
+
+    if os.path.exists(path):
+        instrumentation.count("cache_hits")
+    else:
+        util.save_npy(reduce_features(X, method, n_components, random_state), path)
+
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,172 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from cluster.shared import SharedInput
+import instrumentation
+
+# Trials in flight per pool worker
+TRIALS_PER_WORKER = 2
+
+
+@instrumentation.timed("trials.run_trials")
+def run_trials(trial, X, n_accepted=100, max_trials=1000, seed=0, accept=None, checkpoint=None, pool=None,
+               n_workers=None):
+    """
+    Runs independent trials of an experiment over the same input until n_accepted
+    of them are accepted or max_trials have run.
+
+    Trial i runs with its own seed, derived from seed and i, and the global numpy
+    random state is seeded with it as well, so every trial is reproducible
+    whatever process runs it. Trials are submitted in order and the accepted
+    results returned are the first n_accepted by trial number, so the output
+    doesn't depend on the number of workers either.
+
+    With a checkpoint file, every finished trial is appended to it as a JSON line
+    as soon as it's done. Running again with the same file skips the trials it
+    already holds, so an interrupted experiment resumes where it left off. The
+    checkpoint must have been written with the same seed, a ValueError is raised
+    otherwise; delete it when the experiment or its input changes.
+
+    :param trial: callable, required
+        trial(X, seed) returns a JSON serializable result. It must be picklable
+        (a module function or a functools.partial of one) to run in a pool, and
+        shouldn't start processes of its own (e.g. EAC(n_jobs=1)).
+
+    :param X: input of every trial (see cluster.shared.SharedInput)
+        Published once in shared memory when a pool is given.
+
+    :param n_accepted: int, optional, default: 100
+
+    :param max_trials: int, optional, default: 1000
+        Trial budget
+
+    :param seed: int, optional, default: 0
+
+    :param accept: callable, optional, default: None
+        accept(result) tells if a result is accepted. If None, all of them are
+
+    :param checkpoint: string, optional, default: None
+        Location path of the append-only results file
+
+    :param pool: multiprocessing.Pool, optional, default: None
+        If None, the trials run in the calling process
+
+    :param n_workers: int, optional, default: None
+        Number of processes of pool, TRIALS_PER_WORKER trials per process are
+        kept in flight. None means cpu_count()
+
+    :return results: list of up to n_accepted accepted results, by trial number
+    """
+
+    if accept is None:
+        accept = _accept_all
+
+    done = _load_checkpoint(checkpoint, seed) if checkpoint else {}
+    pending = (i for i in range(max_trials) if i not in done)
+
+    def accepted_count():
+        return sum(1 for record in done.values() if record['accepted'])
+
+    def record_trial(index, trial_seed, result):
+        record = {'trial': index, 'seed': trial_seed, 'accepted': bool(accept(result)), 'result': result}
+        instrumentation.count("trials")
+        done[index] = record
+        if checkpoint:
+            _append_checkpoint(checkpoint, record)
+
+    if pool is None:
+        for index in pending:
+            if accepted_count() >= n_accepted:
+                break
+            record_trial(*_run_trial(trial, X, index, _trial_seed(seed, index)))
+    else:
+        with SharedInput(X) as shared_X:
+            instrumentation.count("bytes_shared", shared_X.nbytes)
+            in_flight = []
+            max_in_flight = TRIALS_PER_WORKER * max(n_workers or multiprocessing.cpu_count(), 1)
+
+            while True:
+                # Keep the pool busy, without running more trials than could still be needed
+                while len(in_flight) < max_in_flight and accepted_count() + len(in_flight) < n_accepted:
+                    index = next(pending, None)
+                    if index is None:
+                        break
+                    in_flight.append(pool.apply_async(_run_trial, (trial, shared_X, index,
+                                                                   _trial_seed(seed, index))))
+
+                if not in_flight:
+                    break
+
+                record_trial(*in_flight.pop(0).get())
+
+    accepted = [done[index]['result'] for index in sorted(done) if done[index]['accepted']]
+
+    if len(accepted) < n_accepted:
+        print("Trial budget exhausted: {} of {} results accepted".format(len(accepted), n_accepted))
+
+    return accepted[:n_accepted]
+
+
+def _run_trial(trial, X, index, trial_seed):
+
+    if isinstance(X, SharedInput):
+        X = X.get()
+
+    np.random.seed(trial_seed)
+
+    with instrumentation.timer("trials.trial", trial=index, seed=trial_seed):
+        return index, trial_seed, trial(X, trial_seed)
+
+
+def _trial_seed(seed, index):
+    """32 bits seed of trial index, independent of the other trials"""
+
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+
+def _accept_all(result):
+    return True
+
+
+def _append_checkpoint(checkpoint, record):
+
+    with open(checkpoint, "a", encoding='utf-8') as checkpointFile:
+        checkpointFile.write(json.dumps(record) + "\n")
+        checkpointFile.flush()
+        os.fsync(checkpointFile.fileno())
+
+
+def _load_checkpoint(checkpoint, seed):
+    """
+    Returns the trials saved in checkpoint by number, ignoring an incomplete last line.
+    Raises ValueError if a trial was run with another seed than the one of seed.
+    """
+
+    done = {}
+    if not os.path.exists(checkpoint):
+        return done
+
+    with open(checkpoint, encoding="utf8") as checkpointFile:
+        lines = checkpointFile.readlines()
+
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Written when the process died
+            continue
+
+        if record['seed'] != _trial_seed(seed, record['trial']):
+            raise ValueError("Trial {} of checkpoint {} wasn't run with seed {}".format(record['trial'], checkpoint,
+                                                                                      seed))
+        done[record['trial']] = record
+
+    if lines and not lines[-1].endswith("\n"):
+        # Start the next record on its own line
+        with open(checkpoint, "a", encoding='utf-8') as checkpointFile:
+            checkpointFile.write("\n")
+
+    return done
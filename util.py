@@ -1,11 +1,44 @@
 import csv
+import os
+import tempfile
 import Entity
-import random
+import numpy as np
+from itertools import islice
+from scipy.optimize import linear_sum_assignment
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+# Default location of the cached corpora, distance matrices, signatures and reductions
+CACHE_DIR = ".cache"
+
+
+def chunked(iterable, chunk_size):
+    """
+    Yields lists of up to chunk_size consecutive elements of iterable
+
+    Parameters
+    ----------
+    iterable : any iterable, e.g. a tweet generator
+    chunk_size : int
+
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def save_to_file(tweets, outputfilepath):
+    """
+    Saves tweets as CSV. tweets can be a generator, rows are written as they come.
+
+    Returns the number of tweets written.
+    """
     print("Saving to:", outputfilepath)
 
+    count = 0
+
     with open(outputfilepath, "w", encoding='utf-8') as saveFile:
         saveFile.write("id,text,type,label\n")
         writer = csv.writer(saveFile, delimiter=",", lineterminator='\n')
@@ -15,10 +48,32 @@ def save_to_file(tweets, outputfilepath):
             tw.text = tw.text.replace("\r", " ").replace("\n", " ")
 
             writer.writerow([tw.id, tw.text, tw.tw_type, tw.label])
+            count += 1
+
+    return count
 
 
 # TODO check for desired format : id,text only
 def read_from_file(inputfilepath):
+
+    return list(iter_from_file(inputfilepath))
+
+
+def read_batch_from_file(inputfilepath):
+    """Reads a CSV file of tweets into an Entity.TweetBatch"""
+
+    ids, texts, types, labels = [], [], [], []
+    for tw in iter_from_file(inputfilepath):
+        ids.append(tw.id)
+        texts.append(tw.text)
+        types.append(tw.tw_type)
+        labels.append(tw.label)
+
+    return Entity.TweetBatch(ids, texts, types, labels)
+
+
+# Yields the tweets of a CSV file one by one
+def iter_from_file(inputfilepath):
     print("Reading :", inputfilepath)
 
     # CSV Fields
@@ -27,7 +82,6 @@ def read_from_file(inputfilepath):
     TYPE = 2
     LABEL = 3
 
-    tweets = []
     with open(inputfilepath, encoding="utf8") as inputFile:
         # Skips header
         next(inputFile)
@@ -39,85 +93,156 @@ def read_from_file(inputfilepath):
             tw.text = line[TEXT]
             tw.tw_type = line[TYPE]
             tw.label = line[LABEL]
-            tweets.append(tw)
-
-    return tweets
+            yield tw
 
 
-def precision(tweets):
+def precision(tweets, verbose=True, scores=False):
     """
     Prints precision of preclassified tweets
 
+    Each type is assigned the cluster that maximizes the total number of
+    tweets matched (Hungarian algorithm), so the result is deterministic.
+
     Parameters
     ----------
-    tweets : Tweet Entity list
+    tweets : Tweet Entity list or Entity.TweetBatch
+
+    verbose : boolean, optional, default: True
+        Print the precision table
+
+    scores : boolean, optional, default: False
+        Also return the adjusted rand index and the normalized mutual information
+
+    Returns
+    -------
+    accuracy : list of lists, row i is the fraction of the tweets of
+        type i in the cluster assigned to each type
+    scores : dict with 'ari' and 'nmi', only if scores is True
 
     """
 
-    accuracy = []
-
-    # Get list of types and clusters
-    seentypes = set()
-    seenclusters = set()
-    types = []
-    clusters = []
-    for tw in tweets:
-        if tw.tw_type not in seentypes:
-            seentypes.add(tw.tw_type)
-            types.append(tw.tw_type)
-        if tw.label not in seenclusters:
-            seenclusters.add(tw.label)
-            clusters.append(tw.label)
-
-    # Find the cluster number better suited for each type
-    types_count = [0] * len(types)
-    assigned_clusters = [0] * len(types)
-    used_clusters = set()
-
-    for i in range(len(types)):
-        cluster = [0] * len(clusters)
-        for tw in tweets:
-            if tw.tw_type == types[i]:
-                types_count[i] += 1
-                if tw.label not in used_clusters:
-                    cluster[tw.label] += 1
-
-        # Get the most frequent cluster for the type i
-        max_acum = max(cluster)
-
-        # Get cluster list index(es) of the most frequent cluster for the type i
-        cluster_number_list = [i for i, j in enumerate(cluster) if j == max_acum]
-
-        # If there is more than one cluster with the same frequency, choose one ramdomly
-        if len(cluster_number_list) > 1:
-            cluster_number = random.choice(cluster_number_list)
-        else:
-            cluster_number = cluster_number_list[0]
-
-        # Prevent the same cluster from being chosen again
-        used_clusters.add(cluster_number)
-
-        assigned_clusters[i] = cluster_number
-
-    # Calculate precision
-    separator = '\t\t\t'
-    print(separator, end='')
-    for tw_type in types:
-        print(tw_type, separator, end='')
-    print('\n')
-    for typeRow in range(len(types)):
-        print(types[typeRow], '\t\t', end='')
-        row = []
-        for typeCol in range(len(types)):
-            total = 0
-            for tw in tweets:
-                if tw.tw_type == types[typeRow] and tw.label == assigned_clusters[typeCol]:
-                    total += 1
-            value = total / types_count[typeRow]
-            row.append(value)
-            print('{:0.3f}'.format(value), separator, end='')
-
-        accuracy.append(row)
+    if isinstance(tweets, Entity.TweetBatch):
+        types, type_ics = get_codes(tweets.types)
+        _, label_ics = get_codes(tweets.labels)
+    else:
+        types, type_ics = get_codes([tw.tw_type for tw in tweets])
+        _, label_ics = get_codes([tw.label for tw in tweets])
+
+    accuracy = precision_batch(type_ics, label_ics[None, :], len(types))[0]
+
+    if verbose:
+        separator = '\t\t\t'
+        print(separator, end='')
+        for tw_type in types:
+            print(tw_type, separator, end='')
         print('\n')
+        for typeRow in range(len(types)):
+            print(types[typeRow], '\t\t', end='')
+            for value in accuracy[typeRow]:
+                print('{:0.3f}'.format(value), separator, end='')
+            print('\n')
+
+    accuracy = accuracy.tolist()
+
+    if scores:
+        return accuracy, {'ari': adjusted_rand_score(type_ics, label_ics),
+                          'nmi': normalized_mutual_info_score(type_ics, label_ics)}
 
     return accuracy
+
+
+def precision_batch(type_ics, labels, n_types=None):
+    """
+    Precision of many clusterings of the same tweets at once
+
+    Parameters
+    ----------
+    type_ics : int array, shape=(n_tweets,)
+        Type of each tweet, from 0 to n_types - 1
+
+    labels : int array, shape=(n_runs, n_tweets)
+        Non negative cluster labels of each run
+
+    n_types : int, optional, default: None (max(type_ics) + 1)
+
+    Returns
+    -------
+    accuracy : array, shape=(n_runs, n_types, n_types)
+        Same as precision, for each run
+
+    """
+
+    type_ics = np.asarray(type_ics)
+    labels = np.asarray(labels)
+    n_runs = labels.shape[0]
+    n_types = n_types or int(type_ics.max()) + 1
+    n_clusters = int(labels.max()) + 1
+
+    # Confusion matrices of all the runs: tweets of each type in each cluster
+    codes = (np.arange(n_runs)[:, None] * n_types + type_ics) * n_clusters + labels
+    confusion = np.bincount(codes.ravel(), minlength=n_runs * n_types * n_clusters)
+    confusion = confusion.reshape(n_runs, n_types, n_clusters)
+
+    types_count = np.bincount(type_ics, minlength=n_types)
+
+    accuracy = np.zeros((n_runs, n_types, n_types))
+    for run in range(n_runs):
+        assigned_clusters = _assign_clusters(confusion[run])
+        accuracy[run] = confusion[run][:, assigned_clusters] / types_count[:, None]
+
+    return accuracy
+
+
+def _assign_clusters(confusion):
+    """
+    Returns the cluster assigned to each type (row of confusion) that
+    maximizes the matched tweets. If there are more types than clusters,
+    the remaining types get their most frequent cluster.
+    """
+
+    assigned_clusters = np.argmax(confusion, axis=1)
+
+    rows, columns = linear_sum_assignment(confusion, maximize=True)
+    assigned_clusters[rows] = columns
+
+    return assigned_clusters
+
+
+def get_codes(values):
+    """Returns the distinct values, in order of appearance, and the index of each value among them"""
+
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        distinct, first, ics = np.unique(values, return_index=True, return_inverse=True)
+
+        # np.unique sorts the values, renumber them by first appearance
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        return distinct[order].tolist(), rank[ics.ravel()]
+
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
+
+    codes = {}
+    ics = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        ics[i] = codes.setdefault(value, len(codes))
+
+    return list(codes), ics
+
+
+def save_npy(array, path):
+    """Saves array aside and renames it, so a partial file is never loaded"""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as tmpfile:
+            np.save(tmpfile, array)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
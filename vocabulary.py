@@ -0,0 +1,144 @@
+import json
+from collections import Counter
+
+
+class Vocabulary:
+    """
+    Terms of a corpus with their number of occurrences, number of documents
+    and an integer id. Ids are given by descending count, then by term.
+
+    Membership and id lookups are dict based, O(1). term_ids can be used as the
+    vocabulary of the sklearn vectorizers, e.g. CountVectorizer(vocabulary=v.term_ids).
+
+    Example
+    -------
+    v = Vocabulary().fit(texts).prune(min_frequency=0.0005)
+    texts = [v.filter(text) for text in texts]
+    """
+
+    def __init__(self):
+
+        self.counts = Counter()
+
+        self.doc_counts = Counter()
+
+        # Number of tokens and documents of the corpus
+        self.total = 0
+
+        self.n_docs = 0
+
+        self.terms = []
+
+        self.term_ids = {}
+
+    def fit(self, texts):
+        """Counts the words of texts in a single pass. texts can be a generator"""
+
+        self.__init__()
+
+        return self.update(texts)
+
+    def update(self, texts):
+        """Adds the words of texts to the counts"""
+
+        for text in texts:
+            words = text.split()
+            self.counts.update(words)
+            self.doc_counts.update(set(words))
+            self.total += len(words)
+            self.n_docs += 1
+
+        self._build_index()
+
+        return self
+
+    def _build_index(self):
+
+        self.terms = sorted(self.counts, key=lambda term: (-self.counts[term], term))
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+
+    def prune(self, min_count=1, min_df=1, min_frequency=0.0, max_terms=None):
+        """
+        Returns a new vocabulary with the terms that pass every criterion.
+        Relative frequencies are still relative to the whole corpus.
+
+        :param min_count: int, optional, default: 1
+            Minimum number of occurrences
+
+        :param min_df: int, optional, default: 1
+            Minimum number of documents the term appears in
+
+        :param min_frequency: float, optional, default: 0.0
+            Minimum occurrences / total number of tokens
+
+        :param max_terms: int, optional, default: None
+            Keep only the max_terms most frequent terms
+
+        :return vocabulary: Vocabulary
+        """
+
+        pruned = Vocabulary()
+        pruned.total = self.total
+        pruned.n_docs = self.n_docs
+
+        for term in self.terms[:max_terms]:
+            count = self.counts[term]
+            if count >= min_count and self.doc_counts[term] >= min_df and \
+                    count >= min_frequency * self.total:
+                pruned.counts[term] = count
+                pruned.doc_counts[term] = self.doc_counts[term]
+
+        pruned._build_index()
+
+        return pruned
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def __getitem__(self, term):
+        return self.term_ids[term]
+
+    def frequency(self, term):
+        """Occurrences of term / total number of tokens"""
+
+        return self.counts[term] / self.total if self.total else 0.0
+
+    def filter(self, text):
+        """Returns text without the words that are not in the vocabulary"""
+
+        return " ".join([word for word in text.split() if word in self.term_ids])
+
+    def to_ids(self, text):
+        """Returns the ids of the words of text that are in the vocabulary"""
+
+        return [self.term_ids[word] for word in text.split() if word in self.term_ids]
+
+    def save(self, outputfilepath):
+        """Saves the vocabulary as JSON"""
+
+        with open(outputfilepath, "w", encoding='utf-8') as saveFile:
+            json.dump({'total': self.total,
+                       'n_docs': self.n_docs,
+                       'terms': [[term, self.counts[term], self.doc_counts[term]] for term in self.terms]},
+                      saveFile, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, inputfilepath):
+        """Loads a vocabulary saved with save"""
+
+        with open(inputfilepath, encoding="utf8") as inputFile:
+            data = json.load(inputFile)
+
+        vocabulary = cls()
+        vocabulary.total = data['total']
+        vocabulary.n_docs = data['n_docs']
+        for term, count, doc_count in data['terms']:
+            vocabulary.counts[term] = count
+            vocabulary.doc_counts[term] = doc_count
+
+        vocabulary._build_index()
+
+        return vocabulary